@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+'''
+Benchmark add, status, commit and log of lgit on synthetic repositories.
+
+    ./bench.py --files 1000,10000,100000 > results.json
+
+Every repository is generated again from the seed, so two runs of the same
+parameters measure the same trees. Each command is run in a child process,
+cold (the files of the repository dropped from the page cache) and warm,
+and its wall time, bytes read and written and peak RSS are printed as JSON.
+'''
+from argparse import ArgumentParser, REMAINDER, SUPPRESS
+from os import path, makedirs, environ, walk, sync
+import os
+import json
+import random
+import resource
+import runpy
+import subprocess
+import sys
+from shutil import rmtree
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter
+
+LGIT = path.join(path.dirname(path.abspath(__file__)), 'lgit.py')
+COMMANDS = ('status', 'add', 'commit', 'log')
+
+
+def getArgs():
+    parser = ArgumentParser(prog='bench.py', description="benchmark lgit\
+ commands on synthetic repositories")
+    parser.add_argument('--files', default='1000,10000',
+                        help="comma separated file counts, one repository\
+ each")
+    parser.add_argument('--depth', type=int, default=3,
+                        help="depth of the dirs the files are spread over")
+    parser.add_argument('--fanout', type=int, default=8,
+                        help="number of sub dirs of a dir")
+    parser.add_argument('--min-size', type=int, default=64,
+                        help="smallest file size in bytes")
+    parser.add_argument('--max-size', type=int, default=64 * 1024,
+                        help="largest file size in bytes, sizes are spread\
+ log-uniformly in between")
+    parser.add_argument('--history', type=int, default=10,
+                        help="number of commits made before measuring")
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help="fraction of the files changed by a commit")
+    parser.add_argument('--commands', default=','.join(COMMANDS),
+                        help="comma separated commands to measure")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each command, the median is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="where the repositories are\
+ generated, a temporary dir by default")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the generated repositories")
+    # used by the benchmark itself to run a measured command
+    parser.add_argument('--child', nargs=REMAINDER, help=SUPPRESS)
+    return parser.parse_args()
+
+
+'''_____________________CHILD_________________________________'''
+
+
+def runChild(argv):
+    '''
+    Run lgit.py in this process, then write what it used to the file given
+    by LGIT_BENCH_REPORT. Reading /proc/self/io from here counts the I/O of
+    the command alone.
+    '''
+    sys.argv = [LGIT] + argv
+    try:
+        runpy.run_path(LGIT, run_name='__main__')
+    finally:
+        sys.stdout.flush()
+        report = {'max_rss_kb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss}
+        try:
+            with open('/proc/self/io') as f:
+                for line in f:
+                    key, value = line.split(':')
+                    report[key] = int(value)
+        except OSError:
+            pass
+        with open(environ['LGIT_BENCH_REPORT'], 'w') as f:
+            json.dump(report, f)
+
+
+'''_____________________GENERATE_________________________________'''
+
+
+# Get the relative paths of count files spread over the dirs
+def getFilePaths(count, depth, fanout, rng):
+    paths = []
+    for number in range(count):
+        dirs = ['d{}'.format(rng.randrange(fanout))
+                for _ in range(rng.randrange(depth + 1))]
+        paths.append(path.join(*dirs, 'f{}.txt'.format(number)))
+    return paths
+
+
+# Get a size between min_size and max_size, small files are more common
+def getFileSize(args, rng):
+    low = max(args.min_size, 1)
+    high = max(args.max_size, low)
+    return int(low * (high / low) ** rng.random())
+
+
+# Get printable content, so diffs and line based code see real lines
+def getFileContent(size, rng):
+    line = rng.randbytes(48).hex().encode() + b'\n'
+    return (line * (size // len(line) + 1))[:size]
+
+
+def writeFiles(root, file_paths, args, rng):
+    for file_path in file_paths:
+        full_path = path.join(root, file_path)
+        makedirs(path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(getFileContent(getFileSize(args, rng), rng))
+
+
+# Rewrite a churn fraction of the files, with new sizes
+def churnFiles(root, file_paths, args, rng):
+    count = max(1, int(len(file_paths) * args.churn))
+    writeFiles(root, rng.sample(file_paths, min(count, len(file_paths))),
+               args, rng)
+
+
+def runLgit(root, argv):
+    subprocess.run([sys.executable, LGIT] + argv, cwd=root, check=True,
+                   stdout=subprocess.DEVNULL, env=getChildEnv())
+
+
+def getChildEnv():
+    env = dict(environ)
+    # init writes the author from LOGNAME
+    env.setdefault('LOGNAME', 'bench')
+    return env
+
+
+def generateRepo(root, count, args):
+    '''
+    output: relative paths of the files of a new repository at root,
+            with args.history commits
+    '''
+    rng = random.Random('{}-{}'.format(args.seed, count))
+    makedirs(root)
+    file_paths = getFilePaths(count, args.depth, args.fanout, rng)
+    writeFiles(root, file_paths, args, rng)
+    runLgit(root, ['init'])
+    runLgit(root, ['add', '.'])
+    runLgit(root, ['commit', '-m', 'initial'])
+    for number in range(1, args.history):
+        churnFiles(root, file_paths, args, rng)
+        runLgit(root, ['add', '.'])
+        runLgit(root, ['commit', '-m', 'commit {}'.format(number)])
+    return file_paths, rng
+
+
+'''_____________________MEASURE_________________________________'''
+
+
+def dropCache(root):
+    '''
+    Evict the files of the repository from the page cache, dirty pages are
+    written first since they can not be dropped
+    '''
+    sync()
+    for dir_path, _, file_names in walk(root):
+        for file_name in file_names:
+            try:
+                fd = os.open(path.join(dir_path, file_name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def warmCache(root):
+    '''
+    Read every file of the repository so it is in the page cache, without
+    running lgit, which would already do the work of the measured command
+    '''
+    for dir_path, _, file_names in walk(root):
+        for file_name in file_names:
+            try:
+                with open(path.join(dir_path, file_name), 'rb') as f:
+                    while f.read(1 << 20):
+                        pass
+            except OSError:
+                continue
+
+
+# Get the command line of a command and prepare the tree it runs on
+def setUpCommand(command, root, file_paths, args, rng):
+    if command == 'status':
+        churnFiles(root, file_paths, args, rng)
+        return ['status']
+    if command == 'add':
+        churnFiles(root, file_paths, args, rng)
+        return ['add', '.']
+    if command == 'commit':
+        churnFiles(root, file_paths, args, rng)
+        runLgit(root, ['add', '.'])
+        return ['commit', '-m', 'bench']
+    return ['log']
+
+
+def measureOnce(root, argv, cold):
+    report_path = path.join(path.dirname(root), 'report.json')
+    if cold:
+        dropCache(root)
+    else:
+        warmCache(root)
+    env = getChildEnv()
+    env['LGIT_BENCH_REPORT'] = report_path
+    start = perf_counter()
+    subprocess.run([sys.executable, path.abspath(__file__), '--child'] +
+                   argv, cwd=root, check=True, stdout=subprocess.DEVNULL,
+                   env=env)
+    wall_time = perf_counter() - start
+    with open(report_path) as f:
+        report = json.load(f)
+    return {'wall_s': wall_time,
+            'read_bytes': report.get('read_bytes'),
+            'write_bytes': report.get('write_bytes'),
+            'rchar': report.get('rchar'),
+            'wchar': report.get('wchar'),
+            'max_rss_kb': report['max_rss_kb']}
+
+
+def measureCommand(command, root, file_paths, args, rng, cold):
+    runs = []
+    for _ in range(args.repeat):
+        argv = setUpCommand(command, root, file_paths, args, rng)
+        runs.append(measureOnce(root, argv, cold))
+    result = {'files': len(file_paths), 'command': command,
+              'cache': 'cold' if cold else 'warm', 'runs': runs}
+    for key in runs[0]:
+        values = [run[key] for run in runs if run[key] is not None]
+        result[key] = median(values) if values else None
+    return result
+
+
+def main():
+    args = getArgs()
+    if args.child is not None:
+        runChild(args.child)
+        return
+    workdir = args.workdir or mkdtemp(prefix='lgit-bench-')
+    results = []
+    try:
+        for count in [int(count) for count in args.files.split(',')]:
+            repo_dir = path.join(workdir, 'files-{}'.format(count))
+            root = path.join(repo_dir, 'repo')
+            rmtree(repo_dir, ignore_errors=True)
+            file_paths, rng = generateRepo(root, count, args)
+            for command in args.commands.split(','):
+                for cold in (True, False):
+                    result = measureCommand(command, root, file_paths,
+                                            args, rng, cold)
+                    print('{files} files, {command} {cache}: {wall_s:.3f}s'
+                          .format(**result), file=sys.stderr)
+                    results.append(result)
+    finally:
+        if not args.keep:
+            rmtree(workdir, ignore_errors=True)
+    params = {key: value for key, value in vars(args).items()
+              if key not in ('child', 'keep', 'workdir')}
+    json.dump({'params': params, 'results': results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
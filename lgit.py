@@ -2,47 +2,92 @@
 from utils import *
 
 
+# Run a command other than init in the repository, output: exit status if
+# the command failed
+def runCommand(args, repo):
+    if args.command == 'add':
+        if getPathspecs(args.files, repo.root) is None:
+            return
+        for item_path in args.files:
+            if path.isfile(item_path):
+                addGitFile(item_path, repo)
+            elif path.isdir(item_path):
+                addGitDir(item_path, repo, args.jobs)
+            elif isPathspecGlob(item_path):
+                addGitGlob(item_path, repo, args.jobs)
+            else:
+                print("fatal: pathspec '{}'".format(item_path) +
+                      "did not match any files")
+    elif args.command == 'commit':
+        message = args.message
+        if message is None:
+            message = ''
+        commitGit(repo, message)
+    elif args.command == 'rm':
+        rmGit(repo, args.rm_files, args.recursive, args.cached)
+    elif args.command == 'config':
+        author = args.author
+        configGit(repo, author, args.compression,
+                  args.untracked_cache, args.fsync, args.chunk_threshold)
+    elif args.command == 'status':
+        if args.all_root is not None:
+            statusAllGit(args.all_root, args.porcelain, args.untracked_cache,
+                         args.jobs)
+        else:
+            checkGitStt(repo, args.porcelain, args.untracked_cache)
+    elif args.command == 'ls-files':
+        lsFileGit(repo, args.pathspecs)
+    elif args.command == 'log':
+        logGit(repo, args.max_count, args.since, args.oneline)
+    elif args.command == 'gc':
+        repackGit(repo, args.prune)
+    elif args.command == 'repack':
+        repackGit(repo)
+    elif args.command == 'fsck':
+        if not fsckGit(repo, args.fast, args.jobs):
+            return 1
+    elif args.command == 'checkout':
+        checkoutGit(repo, args.targets, args.force, args.jobs)
+    elif args.command == 'diff':
+        diffGit(repo, args.targets, args.cached)
+    elif args.command == 'fsmonitor':
+        fsmonitorGit(repo, args.action)
+
+
 def main():
     args = getArgs()
+    startTrace(args.trace_output or args.trace_perf or
+               environ.get('LGIT_TRACE'))
     # print(args)
     if args.command == 'init':
         if args.init_dir:
             initGit(args.init_dir)
         else:
             initGit()
+    elif args.command == 'status' and args.all_root is not None:
+        # the repositories are found under the root, it needs not be one
+        statusAllGit(args.all_root, args.porcelain, args.untracked_cache,
+                     args.jobs)
     else:
-        lgit_parent_path = getGitParentPath()
-        if lgit_parent_path is None:
+        # The repository is found once, commands share its index and config
+        repo = Repository.discover()
+        if repo is None:
             print('fatal: not a git repository\
  (or any of the parent directories)')
+        elif args.command == 'batch':
+            batchGit(repo, runCommand, args.socket)
         else:
-            lgit_path = path.join(getGitParentPath(), '.lgit')
-            if args.command == 'add':
-                for item_path in args.files:
-                    if path.isfile(item_path):
-                        addGitFile(item_path, lgit_path, lgit_parent_path)
-                    elif path.isdir(item_path):
-                        addGitDir(item_path, lgit_path, lgit_parent_path)
-                    else:
-                        print("fatal: pathspec '{}'".format(item_path) +
-                              "did not match any files")
-            elif args.command == 'commit':
-                message = args.message
-                if message is None:
-                    message = ''
-                commitGit(lgit_path, lgit_parent_path, message)
-            elif args.command == 'rm':
-                for file in args.rm_files:
-                    rmGit(file, lgit_path)
-            elif args.command == 'config':
-                author = args.author
-                configGit(author, lgit_path)
-            elif args.command == 'status':
-                checkGitStt()
-            elif args.command == 'ls-files':
-                lsFileGit()
-            elif args.command == 'log':
-                logGit(lgit_path)
+            status = None
+            try:
+                status = runCommand(args, repo)
+                # Write the index back once at the end of the command
+                repo.flush()
+            except LockError as e:
+                print('fatal:', e)
+            finally:
+                repo.rollback()
+            if status:
+                sys.exit(status)
 
 
 if __name__ == '__main__':
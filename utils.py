@@ -1,52 +1,178 @@
 from argparse import ArgumentParser
 from os import path, mkdir, walk
-from os import environ, getcwd, chdir, listdir, unlink
+from os import environ, getcwd, chdir, listdir, unlink, stat, fstat
+from os import cpu_count, makedirs, rename, fdopen, fchmod, rmdir
+from os import fsencode, fsdecode, scandir
+from os import read, close, getpid, fork, setsid, waitpid, dup2, _exit
+from os import devnull as devnull_path
+from os import open as openFd, write as writeFd, fsync, umask
+from os import O_CREAT, O_EXCL, O_WRONLY, O_RDONLY, O_CLOEXEC
+from tempfile import mkstemp, gettempdir
+from socket import socket, AF_UNIX, SOCK_STREAM
+from selectors import DefaultSelector, EVENT_READ
+from ctypes.util import find_library
+from uuid import uuid4
+from time import sleep, perf_counter
+from threading import Lock, get_ident
+import atexit
+import ctypes
+import errno
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import as_completed
 from shutil import rmtree
 from hashlib import sha1
+import zlib
+import re
+from fnmatch import fnmatchcase
+from operator import length_hint
+import json
+from mmap import mmap, ACCESS_READ
+from struct import Struct
 from datetime import datetime
+from itertools import islice
+from collections import OrderedDict
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from stat import S_ISREG
+from math import isqrt
+from bisect import bisect_left
+import shlex
+import sys
 
 
-def getArgs():
+# The parser is built once, batch mode parses every command with it
+PARSER = None
+
+
+def getParser():
+    global PARSER
+    if PARSER is not None:
+        return PARSER
     parser = ArgumentParser(prog='lgit.py', description=None)
+    parser.add_argument('--trace-perf', action='store_const', const='summary',
+                        help="time the hot functions and print a summary,\
+ LGIT_TRACE=1 does the same")
+    parser.add_argument('--trace-output', metavar='FILE', help="write the\
+ trace as Chrome trace-event JSON to FILE, like LGIT_TRACE=FILE")
     sub_parsers = parser.add_subparsers(dest='command')
 
     sub_parsers_init = sub_parsers.add_parser('init')
     sub_parsers_init.add_argument('init_dir', nargs='?')
 
     sub_parsers_status = sub_parsers.add_parser('status')
+    sub_parsers_status.add_argument('--porcelain', action='store_true',
+                                    help="give the output in a stable,\
+ easy-to-parse format")
+    sub_parsers_status.add_argument('--no-untracked-cache',
+                                    dest='untracked_cache',
+                                    action='store_false',
+                                    help="list every dir again instead of\
+ using the untracked cache")
+    sub_parsers_status.add_argument('--all', dest='all_root', metavar='ROOT',
+                                    nargs='?', const='.',
+                                    help="show a summary of every repository\
+ under ROOT, the current dir by default")
+    sub_parsers_status.add_argument('-j', '--jobs', type=int,
+                                    default=cpu_count(),
+                                    help="number of repositories checked in\
+ parallel with --all")
 
     sub_parsers_add = sub_parsers.add_parser('add')
     sub_parsers_add.add_argument('files', nargs='*', help="file to add")
+    sub_parsers_add.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                                 help="number of files hashed and stored\
+ in parallel")
 
     sub_parsers_rm = sub_parsers.add_parser('rm')
     sub_parsers_rm.add_argument('rm_files', nargs='*', help="file to add")
+    sub_parsers_rm.add_argument('-r', dest='recursive', action='store_true',
+                                help="allow removing the files under a dir")
+    sub_parsers_rm.add_argument('--cached', action='store_true',
+                                help="only remove from the index, keep the\
+ files in the working tree")
 
     sub_parsers_commit = sub_parsers.add_parser('commit')
     sub_parsers_commit.add_argument('-m', dest='message')
 
     sub_parsers_config = sub_parsers.add_parser('config')
     sub_parsers_config.add_argument('--author', action='store')
+    sub_parsers_config.add_argument('--untracked-cache',
+                                    choices=('true', 'false'),
+                                    help="let status reuse the listing of\
+ dirs whose mtime did not change")
+    sub_parsers_config.add_argument('--chunk-threshold', metavar='SIZE',
+                                    help="store files from this size (like\
+ 64M) in content defined chunks, 0 to turn it off")
+    sub_parsers_config.add_argument('--fsync', choices=('true', 'false'),
+                                    help="sync new objects and files to\
+ disk before the index and HEAD refer to them")
+    sub_parsers_config.add_argument('--compression', type=int,
+                                    choices=range(0, 10), metavar='LEVEL',
+                                    help="zlib level of new objects,\
+ 0 stores them uncompressed")
 
     sub_parsers_ls_files = sub_parsers.add_parser('ls-files')
+    sub_parsers_ls_files.add_argument('pathspecs', nargs='*',
+                                      help="paths, dirs or globs to list")
 
     sub_parsers_log = sub_parsers.add_parser('log')
+    sub_parsers_log.add_argument('-n', '--max-count', type=int,
+                                 help="limit the number of commits to show")
+    sub_parsers_log.add_argument('--since', help="show commits more recent\
+ than a date (YYYY-mm-dd [HH:MM:SS])")
+    sub_parsers_log.add_argument('--oneline', action='store_true',
+                                 help="show each commit on a single line")
 
-    args = parser.parse_args()
-    return args
+    sub_parsers_checkout = sub_parsers.add_parser('checkout')
+    sub_parsers_checkout.add_argument('-f', '--force', action='store_true',
+                                      help="switch even if local changes\
+ are lost")
+    sub_parsers_checkout.add_argument('-j', '--jobs', type=int,
+                                      default=cpu_count(),
+                                      help="number of files written in\
+ parallel")
+    sub_parsers_checkout.add_argument('targets', nargs='*',
+                                      help="[<commit>] [--] [<path>...]")
 
+    sub_parsers_diff = sub_parsers.add_parser('diff')
+    sub_parsers_diff.add_argument('--cached', action='store_true',
+                                  help="show the changes staged for the\
+ next commit")
+    sub_parsers_diff.add_argument('targets', nargs='*',
+                                  help="[<commit> [<commit>]] [--]\
+ [<path>...]")
 
-def getTimeStamp(filepath, mcr_sec=False):
-    '''
-    input: filename:path to file; mcr_sec:return time in milisec True or False
-    output: time in year, month, day, hour, minute, second format
-    '''
-    t = path.getmtime(filepath)  # Get modify time of the file
-    if mcr_sec:
-        # return time format in microsec
-        return datetime.fromtimestamp(t).strftime('%Y%m%d%H%M%S.%f')
-    else:
-        # return time format in sec
-        return datetime.fromtimestamp(t).strftime('%Y%m%d%H%M%S')
+    sub_parsers_gc = sub_parsers.add_parser('gc')
+    sub_parsers_gc.add_argument('--prune', action='store_true',
+                                help="remove the objects nothing refers to")
+
+    sub_parsers_repack = sub_parsers.add_parser('repack')
+
+    sub_parsers_fsck = sub_parsers.add_parser('fsck')
+    sub_parsers_fsck.add_argument('--fast', action='store_true',
+                                  help="stop at the first error")
+    sub_parsers_fsck.add_argument('-j', '--jobs', type=int,
+                                  default=cpu_count(),
+                                  help="number of processes checking\
+ objects")
+
+    sub_parsers_fsmonitor = sub_parsers.add_parser('fsmonitor')
+    sub_parsers_fsmonitor.add_argument('action', nargs='?', default='status',
+                                       choices=('start', 'stop', 'run',
+                                                'status'))
+
+    sub_parsers_batch = sub_parsers.add_parser('batch')
+    sub_parsers_batch.add_argument('--socket', metavar='PATH',
+                                   help="read the commands from clients of\
+ a unix socket instead of stdin")
+
+    PARSER = parser
+    return parser
+
+
+def getArgs(argv=None):
+    args = getParser().parse_args(argv)
+    return args
 
 
 # Helper Function for initGit to process destination dir recursively
@@ -177,25 +303,484 @@ def getGitParentPath():
     return None  # Return None if cwd is not init'ed yet
 
 
-# Get info of a field (timestamp, current hash,..., file in a line of Index)
-def getInfoOfField(index_line, field):
-    if field == 0:  # Get timestamp
-        return index_line[:14]
-    elif field == 1:
-        return index_line[15:15+40]
-    elif field == 2:
-        return index_line[56:56+40]
-    elif field == 3:
-        return index_line[97:97+40]
-    elif field == 4:
-        return index_line[138:].strip('\n')
+# The lgit repository a command runs in. Its paths are found once per
+# process, its config and index are loaded on first use and shared by the
+# commands, which all receive it.
+class Repository:
+    def __init__(self, root, lgit_path=None):
+        self.root = root
+        self.lgit_path = lgit_path or path.join(root, '.lgit')
+        self.config = None
+        self.index = None
+        # LockFile of the index while this process changes it
+        self.index_lock = None
+
+    @classmethod
+    def discover(cls):
+        '''
+        output: Repository of the current working directory, or of the
+                .lgit dir given by LGIT_DIR, None if there is none
+        '''
+        lgit_dir = environ.get('LGIT_DIR')
+        if lgit_dir:
+            lgit_dir = path.abspath(lgit_dir)
+            if not path.isdir(lgit_dir):
+                return None
+            return cls(path.dirname(lgit_dir), lgit_dir)
+        root = getGitParentPath()
+        return None if root is None else cls(root)
+
+    def getConfig(self):
+        if self.config is None:
+            self.config = readConfig(self.lgit_path)
+        return self.config
+
+    def updateConfig(self, changes):
+        '''
+        input: changes: dict of the config keys to set
+        output: the config is read again and written under its lock, so
+                changes of other processes are kept
+        '''
+        with LockFile(path.join(self.lgit_path, 'config')).acquire() as lock:
+            config = readConfig(self.lgit_path)
+            config.update(changes)
+            lock.write(formatConfig(config).encode())
+            lock.commit()
+        self.config = config
+
+    def getCompressionLevel(self):
+        try:
+            return int(self.getConfig().get('compression', 0))
+        except ValueError:
+            return 0
+
+    def getChunkThreshold(self):
+        '''
+        output: size from which files are stored in chunks, 0 if never
+        '''
+        try:
+            return parseSize(self.getConfig().get('chunk_threshold', '0'))
+        except ValueError:
+            return 0
+
+    def getIndex(self, write=False):
+        '''
+        input: write: True for a command that changes the index, it is then
+               locked until flush, so concurrent commands do not lose
+               each other's changes
+        '''
+        if write and self.index_lock is None:
+            self.index_lock = LockFile(
+                path.join(self.lgit_path, 'index')).acquire()
+            setFsync(self.getConfig().get('fsync') != 'false')
+            # another process may have written it since it was read
+            if self.index is not None and self.index.isStale():
+                self.index.close()
+                self.index = None
+        if self.index is None:
+            self.index = Index(self.lgit_path)
+        return self.index
+
+    def flush(self):
+        '''
+        output: write the index back once, at the end of the commands,
+                False if the changes of a status had to be dropped
+        '''
+        if self.index is None:
+            return True
+        lock, self.index_lock = self.index_lock, None
+        if lock is None and self.index.dirty:
+            # status only refreshes stat data, skip it if the index is busy
+            # or was changed by another process
+            lock = LockFile(self.index.index_path).acquire(timeout=0,
+                                                           wait=False)
+            if lock is None:
+                return False
+            if self.index.isStale():
+                lock.rollback()
+                return False
+        if lock is not None:
+            with lock:
+                self.index.flush(lock)
+        return True
+
+    def reload(self):
+        '''
+        output: the config and the index are read again on next use if
+                another process may have changed them, for a server
+                running the commands of many clients
+        '''
+        self.config = None
+        if self.index is not None and self.index.isStale():
+            self.index.close()
+            self.index = None
+
+    def rollback(self):
+        '''
+        output: release the lock of the index without writing it, after a
+                failed command
+        '''
+        if self.index_lock is not None:
+            self.index_lock.rollback()
+            self.index_lock = None
+
+
+'''_____________________GIT INDEX_________________________________'''
+
+
+# The index is a binary file: a header (magic, version, count), records of
+# fixed width sorted by path, then the paths they point to. It is mmapped
+# and a path is looked up with binary search over the records.
+INDEX_MAGIC = b'LIDX'
+INDEX_VERSION = 3
+INDEX_HEADER = Struct('>4sII')
+# path offset, path length, timestamp, current, add and commit SHA1,
+# flags, size, mtime_ns, inode, ctime_ns
+INDEX_RECORD = Struct('>QI14s20s20s20sBQQQQ')
+# Unpack (path offset, path length) at the start of a record
+unpackPathOfRecord = Struct('>QI').unpack_from
+INDEX_FLAG_COMMITTED = 1
+# First line of the older text index with stat data, before it had none
+TEXT_INDEX_HEADER = 'LGIT-INDEX 2\n'
+NS_PER_SEC = 10**9
+
+
+# Format a mtime in seconds as the timestamp saved in the index
+def formatTimeStamp(mtime):
+    return datetime.fromtimestamp(mtime).strftime('%Y%m%d%H%M%S')
+
+
+# One entry of the index, parsed into typed fields
+class IndexEntry:
+    __slots__ = ('timestamp', 'current_hash', 'add_hash', 'commit_hash',
+                 'path', 'size', 'mtime_ns', 'ino', 'ctime_ns')
+
+    def __init__(self, timestamp, current_hash, add_hash, commit_hash,
+                 file_name, size=0, mtime_ns=0, ino=0, ctime_ns=0):
+        self.timestamp = timestamp
+        self.current_hash = current_hash
+        self.add_hash = add_hash
+        # None when the file has never been committed
+        self.commit_hash = commit_hash
+        self.path = file_name
+        # stat data of the file when current_hash was computed,
+        # all 0 when unknown so the file gets rehashed
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ino = ino
+        self.ctime_ns = ctime_ns
+
+    @classmethod
+    def fromLine(cls, index_line, with_stat=True):
+        '''
+        input: a line of the text index; with_stat: the line has stat data
+        output: IndexEntry of that line
+        '''
+        commit_hash = index_line[97:97+40].strip() or None
+        if not with_stat:
+            return cls(index_line[:14], index_line[15:15+40],
+                       index_line[56:56+40], commit_hash,
+                       index_line[138:].rstrip('\n'))
+        size, mtime_ns, ino, ctime_ns = index_line[138:138+83].split()
+        return cls(index_line[:14], index_line[15:15+40],
+                   index_line[56:56+40], commit_hash,
+                   index_line[222:].rstrip('\n'), int(size), int(mtime_ns),
+                   int(ino), int(ctime_ns))
+
+    @classmethod
+    def fromRecord(cls, record, file_name):
+        '''
+        input: record: unpacked INDEX_RECORD; file_name: path of the record
+        output: IndexEntry of that record
+        '''
+        (_, _, timestamp, current_hash, add_hash, commit_hash, flags,
+         size, mtime_ns, ino, ctime_ns) = record
+        if flags & INDEX_FLAG_COMMITTED:
+            commit_hash = commit_hash.hex()
+        else:
+            commit_hash = None
+        return cls(timestamp.decode(), current_hash.hex(), add_hash.hex(),
+                   commit_hash, file_name, size, mtime_ns, ino, ctime_ns)
+
+    def toRecord(self, path_offset, path_length):
+        flags = 0
+        commit_hash = bytes(20)
+        if self.commit_hash:
+            flags |= INDEX_FLAG_COMMITTED
+            commit_hash = bytes.fromhex(self.commit_hash)
+        return INDEX_RECORD.pack(
+            path_offset, path_length, self.timestamp.encode(),
+            bytes.fromhex(self.current_hash), bytes.fromhex(self.add_hash),
+            commit_hash, flags, self.size, self.mtime_ns, self.ino,
+            self.ctime_ns)
+
+    def setStat(self, st):
+        self.timestamp = formatTimeStamp(st.st_mtime)
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.ino = st.st_ino
+        self.ctime_ns = st.st_ctime_ns
+
+    def isStatChanged(self, st):
+        return (self.size != st.st_size or self.mtime_ns != st.st_mtime_ns or
+                self.ino != st.st_ino or self.ctime_ns != st.st_ctime_ns)
+
+    def isStaged(self):
+        # if added field and commited field is difference: means staged
+        return self.add_hash != self.commit_hash
+
+    def isUnstaged(self):
+        # if hash of current file and added is difference: means unstaged
+        return self.current_hash != self.add_hash
+
+
+# The index loaded once per command. Entries on disk are read lazily from
+# the mmapped file, changes are kept in memory until flush() at the end.
+class Index:
+    def __init__(self, lgit_path):
+        self.index_path = path.join(lgit_path, 'index')
+        self.mm = None
+        self.count = 0
+        # entries read from the file, by path
+        self.loaded = {}
+        # entries added or changed, and paths removed, since the load
+        self.changed = {}
+        self.removed = set()
+        self.dirty = False
+        # mtime of the index file when loaded, for the racy check
+        self.mtime_ns = 0
+        # (inode, mtime, size) of the file read, to tell if it was replaced
+        self.file_id = None
+        # paths whose stat data was refreshed by this process
+        self.refreshed = set()
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            file_stat = fstat(f.fileno())
+            self.mtime_ns = file_stat.st_mtime_ns
+            self.file_id = getFileId(file_stat)
+            if not file_stat.st_size:
+                return
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                self.loadText()
+                return
+            self.mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        magic, version, self.count = INDEX_HEADER.unpack_from(self.mm)
+        if version != INDEX_VERSION:
+            raise ValueError('unsupported index version: {}'.format(version))
+
+    def loadText(self):
+        '''
+        Read an index in the older text format, it is written again in the
+        binary format on the next flush
+        '''
+        with open(self.index_path, 'r', errors='surrogateescape') as f:
+            with_stat = f.readline() == TEXT_INDEX_HEADER
+            if not with_stat:
+                f.seek(0)
+            for index_line in f:
+                if index_line.strip():
+                    entry = IndexEntry.fromLine(index_line, with_stat)
+                    self.changed[entry.path] = entry
+        self.dirty = True
+
+    def isStale(self):
+        # True if the file was written by someone else since it was read
+        try:
+            return getFileId(stat(self.index_path)) != self.file_id
+        except FileNotFoundError:
+            return self.file_id is not None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def getRecord(self, pos):
+        offset = INDEX_HEADER.size + pos * INDEX_RECORD.size
+        return INDEX_RECORD.unpack_from(self.mm, offset)
+
+    def getRecordPath(self, pos):
+        offset = INDEX_HEADER.size + pos * INDEX_RECORD.size
+        path_offset, path_length = unpackPathOfRecord(self.mm, offset)
+        return self.mm[path_offset:path_offset + path_length]
+
+    def getEntryAt(self, pos):
+        record = self.getRecord(pos)
+        file_name = fsdecode(self.mm[record[0]:record[0] + record[1]])
+        entry = self.loaded.get(file_name)
+        if entry is None:
+            entry = IndexEntry.fromRecord(record, file_name)
+            self.loaded[file_name] = entry
+        return entry
+
+    def findRecord(self, file_name):
+        '''
+        input: path saved in the index
+        output: position of its record in the file, None if not in the file
+        '''
+        key = fsencode(file_name)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self.getRecordPath(mid)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def get(self, file_name):
+        if file_name in self.changed:
+            return self.changed[file_name]
+        if file_name in self.removed or self.mm is None:
+            return None
+        if file_name in self.loaded:
+            return self.loaded[file_name]
+        pos = self.findRecord(file_name)
+        return None if pos is None else self.getEntryAt(pos)
+
+    def __contains__(self, file_name):
+        return self.get(file_name) is not None
+
+    def findFirstRecord(self, key):
+        # position of the first record whose path is not less than key
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.getRecordPath(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def getEntriesUnder(self, prefix):
+        '''
+        input: prefix: start of the paths, '' for all
+        output: entries whose path starts with prefix, sorted by path, the
+                records are found with binary search so the cost is that
+                of the matches, not of the index
+        '''
+        if not prefix:
+            return self.getEntries()
+        key = fsencode(prefix)
+        entries = {}
+        pos = self.findFirstRecord(key)
+        while pos < self.count and self.getRecordPath(pos).startswith(key):
+            entry = self.getEntryAt(pos)
+            if entry.path not in self.removed:
+                entries[entry.path] = entry
+            pos += 1
+        for file_name, entry in self.changed.items():
+            if file_name.startswith(prefix):
+                entries[file_name] = entry
+        return [entries[file_name]
+                for file_name in sorted(entries, key=fsencode)]
+
+    def getEntries(self):
+        '''
+        output: list of all entries sorted by path
+        '''
+        entries = [self.getEntryAt(pos) for pos in range(self.count)]
+        if self.removed:
+            entries = [entry for entry in entries
+                       if entry.path not in self.removed]
+        if not self.changed:
+            # records in the file are already sorted
+            return entries
+        entries = {entry.path: entry for entry in entries}
+        entries.update(self.changed)
+        return [entries[file_name]
+                for file_name in sorted(entries, key=fsencode)]
+
+    def __iter__(self):
+        return iter(self.getEntries())
+
+    def __len__(self):
+        return len(self.getEntries())
+
+    def setEntry(self, entry):
+        self.changed[entry.path] = entry
+        self.removed.discard(entry.path)
+        self.dirty = True
+
+    def remove(self, file_name):
+        if self.get(file_name) is None:
+            return False
+        self.changed.pop(file_name, None)
+        self.removed.add(file_name)
+        self.dirty = True
+        return True
+
+    def isRacy(self, entry):
+        '''
+        A file modified in the same second the index was written may have
+        changed again after it was hashed without its stat data changing
+        '''
+        return entry.mtime_ns // NS_PER_SEC >= self.mtime_ns // NS_PER_SEC
+
+    def isUpToDate(self, entry, st):
+        '''
+        input: entry of the index; st: stat of the file in working tree
+        output: True if current_hash of the entry can be trusted without
+                reading the file
+        '''
+        return not (entry.isStatChanged(st) or self.isRacy(entry))
 
+    def refreshStat(self, entry, st):
+        entry.setStat(st)
+        self.refreshed.add(entry.path)
+        self.setEntry(entry)
 
-def detectLineOfFile(file, index_content):
-    for idx, index_line in enumerate(index_content):
-        file_name = getInfoOfField(index_line, 4)
-        if file == file_name:
-            return idx
+    def flush(self, lock=None):
+        '''
+        input: lock: LockFile of the index held by the caller, else it is
+               taken here
+        output: write the index file once if anything was changed
+        '''
+        if not self.dirty:
+            return
+        if lock is None:
+            with LockFile(self.index_path).acquire() as lock:
+                self.flush(lock)
+            return
+        entries = self.getEntries()
+        records = []
+        paths = []
+        path_offset = INDEX_HEADER.size + len(entries) * INDEX_RECORD.size
+        for entry in entries:
+            # Once rewritten the index is newer than racy entries that
+            # were not checked again, so force their next rehash
+            if entry.path not in self.refreshed and self.isRacy(entry):
+                entry.mtime_ns = 0
+            encoded_path = fsencode(entry.path)
+            records.append(entry.toRecord(path_offset, len(encoded_path)))
+            paths.append(encoded_path)
+            path_offset += len(encoded_path)
+        content = b''.join([INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                              len(entries))] +
+                           records + paths)
+        self.close()
+        # written to the lock then renamed, so it is never seen half written
+        lock.write(content)
+        lock.commit()
+        self.loaded = {}
+        self.changed = {entry.path: entry for entry in entries}
+        self.removed = set()
+        self.count = 0
+        self.dirty = False
+        # a process flushing again checks raciness against the new file
+        file_stat = stat(self.index_path)
+        self.mtime_ns = file_stat.st_mtime_ns
+        self.file_id = getFileId(file_stat)
+        self.refreshed = set()
 
 
 # Read the content of a file
@@ -209,423 +794,3615 @@ def getFileContent(file):
         pass
 
 
-# Write the content to a file
+# Write the content to a file, aside then renamed over it, so a reader
+# or a crash never sees it half written
 def writeFileContent(file, content):
-    with open(file, 'w+') as f:
-        f.write(content)
-
-
-# Append the content to a file
-def appendFileContent(file, content):
+    fd, tmp_path = mkstemp(prefix='tmp_', dir=path.dirname(file) or '.')
     try:
-        with open(file, 'a+') as f:
+        with fdopen(fd, 'w') as f:
             f.write(content)
-    except FileNotFoundError:
-        print("fatal: pathspec '{}' did not match any files".format(file))
-        pass
+        rename(tmp_path, file)
+    except BaseException:
+        unlink(tmp_path)
+        raise
+    markWritten(file)
 
 
-def updateObjectsWithAdd(lgit_path, file_content, file_hash):
-    object_dir_path = path.join(lgit_path, 'objects')
-    object_sub_dir_path = path.join(object_dir_path, file_hash[:2])
-    try:
-        mkdir(object_sub_dir_path)
-    except FileExistsError:
-        pass
-    file_content = ''.join(file_content)
-    object_file_path = path.join(object_sub_dir_path, file_hash[2:])
-    writeFileContent(object_file_path, file_content)
+'''_____________________GIT LOCK_________________________________'''
 
 
-# lgit add a file
-def addGitFile(file, lgit_path, lgit_parent_path):
-    index_path = path.join(lgit_path, 'index')
-    index_content = getFileContent(index_path)
-    file_hash = getSha1(file)
-    if index_content is not None and file_hash is not None:
-        file_timestamp = getTimeStamp(file)
-        file_content = getFileContent(file)
-        updateObjectsWithAdd(lgit_path, file_content, file_hash)
-        # Update the index file
-        abs_file_path = path.abspath(file)
-        # If the file not in lgit's parent
-        if lgit_parent_path != abs_file_path[:-len(file)-1]:
-            file = abs_file_path[len(lgit_parent_path)+1:]
-        file_line_idx = detectLineOfFile(file, index_content)
-        if file_line_idx is None:
-            commit_file_index = ' '*40
-            new_file_line = ' '.join([file_timestamp, file_hash, file_hash,
-                                      commit_file_index, file])
-            appendFileContent(index_path, new_file_line + '\n')
-        else:
-            commit_file_index = getInfoOfField(index_content[file_line_idx], 3)
-            new_file_line = ' '.join([file_timestamp, file_hash, file_hash,
-                                      commit_file_index, file])
-            index_content[file_line_idx] = new_file_line + '\n'
-            new_index_content = ''.join(index_content)
-            writeFileContent(index_path, new_index_content)
+LOCK_SUFFIX = '.lock'
+# Seconds to wait for another lgit process to release a lock
+LOCK_TIMEOUT = 30
 
 
-# Get all the paths in a dir recursively
-def getDirRecursively(dir):
-    paths = []
-    for root, _, files in walk(dir):
-        for file in files:
-            file_path = path.join(root, file)
-            if '.lgit/' not in file_path:
-                paths.append(file_path)
-    return paths
+class LockError(Exception):
+    pass
 
 
-# lgit add dir
-def addGitDir(dir, lgit_path, lgit_parent_path):
-    files = getDirRecursively(dir)
-    for file in files:
-        addGitFile(file, lgit_path, lgit_parent_path)
+# A file shared by processes is changed by writing its new content to
+# '<file>.lock', which only one process can create, then renaming the lock
+# over the file. Readers never see a half written file and a crash leaves
+# the old one.
+class LockFile:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock_path = file_path + LOCK_SUFFIX
+        self.fd = None
 
+    def acquire(self, timeout=LOCK_TIMEOUT, wait=True):
+        '''
+        output: the LockFile once created, if another process holds it for
+                more than timeout, LockError or None if not wait
+        '''
+        deadline = perf_counter() + timeout
+        delay = 0.001
+        while True:
+            try:
+                self.fd = openFd(self.lock_path,
+                                 O_CREAT | O_EXCL | O_WRONLY | O_CLOEXEC,
+                                 0o644)
+                return self
+            except FileExistsError:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    if not wait:
+                        return None
+                    raise LockError(
+                        "Unable to create '{}': File exists. Another lgit"
+                        " process seems to be running, if not remove the"
+                        " file".format(self.lock_path))
+            sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
 
-# Git commit functions
-# Get timestamp of the current time.
-def getTimeStampNow(mcr_sec=False):
-    if mcr_sec:
-        return datetime.now().strftime('%Y%m%d%H%M%S.%f')
-    else:
-        return datetime.now().strftime('%Y%m%d%H%M%S')
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[writeFd(self.fd, view):]
 
+    def commit(self):
+        '''
+        output: replace the file by the content written to the lock, the
+                files written before are synced with it
+        '''
+        syncWritten(path.dirname(self.lock_path))
+        if FSYNC_ENABLED:
+            fsync(self.fd)
+        close(self.fd)
+        self.fd = None
+        rename(self.lock_path, self.file_path)
+        syncDir(path.dirname(self.file_path))
 
-# Update the commits dir when lgit commit
-def updateCommits(commits_path, file_name, author_name, message):
-    now_time = getTimeStampNow()
-    content = '\n'.join([author_name, now_time, '', message, ''])
-    file_path = path.join(commits_path, file_name)
-    writeFileContent(file_path, content)
+    def rollback(self):
+        # release the lock, the file is left as it was
+        if self.fd is not None:
+            close(self.fd)
+            self.fd = None
+            try:
+                unlink(self.lock_path)
+            except FileNotFoundError:
+                pass
 
+    def __enter__(self):
+        return self
 
-# Update the snapshots and index when lgit commit
-def updateSnapshotsAndIndex(snapshots_path, file_name, index_path):
-    index_content = getFileContent(index_path)
-    snapshots_file_path = path.join(snapshots_path, file_name)
-    is_commited = False
-    for idx, index_line in enumerate(index_content):
-        timestamp_info = getInfoOfField(index_line, field=0)
-        current_info = getInfoOfField(index_line, field=1)
-        add_info = getInfoOfField(index_line, field=2)
-        commit_info = getInfoOfField(index_line, field=3)
-        file_name_info = getInfoOfField(index_line, field=4)
-        if add_info != commit_info:
-            commit_info = add_info
-            is_commited = True
-            new_line_content = ' '.join([timestamp_info, current_info,
-                                        add_info, commit_info, file_name_info])
-            index_content[idx] = new_line_content + '\n'
-            snapshots_content = ' '.join([commit_info, file_name_info]) + '\n'
-            appendFileContent(snapshots_file_path, snapshots_content)
-    if is_commited:
-        new_index_content = ''.join(index_content)
-        writeFileContent(index_path, new_index_content)
-    else:
-        print('no changes added to commit')
-    return is_commited
+    def __exit__(self, *exc):
+        self.rollback()
 
 
-# lgit commit
-def commitGit(lgit_path, lgit_parent_path, message):
-    commits_path = path.join(lgit_path, 'commits')
-    snapshots_path = path.join(lgit_path, 'snapshots')
-    config_path = path.join(lgit_path, 'config')
-    index_path = path.join(lgit_path, 'index')
-    config_content = getFileContent(config_path)
-    author_name = config_content[-1].strip('\n')
-    file_name = getTimeStampNow(mcr_sec=True)
-    if updateSnapshotsAndIndex(snapshots_path, file_name, index_path):
-        updateCommits(commits_path, file_name, author_name, message)
+# Identity of a file version, changed when it is replaced or written
+def getFileId(file_stat):
+    return (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
 
 
-'''___________________________GIT STATUS_________________________________'''
+# Files are not synced as they are written: their paths are only recorded,
+# then one syncfs of the file system of .lgit before the first lock of the
+# command is committed makes them durable before the index or HEAD can
+# refer to them
+FSYNC_ENABLED = True
+SYNC_PENDING = set()
+LIBC = None
+
 
+def setFsync(enabled):
+    global FSYNC_ENABLED
+    FSYNC_ENABLED = enabled
 
-def updateWithStatus(line, file_path):
-    # get 5 field from the line
-    field0 = getTimeStamp(file_path)
-    field1 = getSha1(file_path)
-    field2 = getInfoOfField(line, 2)
-    field3 = getInfoOfField(line, 3)
-    field4 = getInfoOfField(line, 4)
-    # update the line with new field
-    replace_line = ' '.join([field0, field1, field2, field3, field4]) + '\n'
-    return replace_line
 
+# Record a file written by this process, safe to call from worker threads
+def markWritten(file_path):
+    SYNC_PENDING.add(file_path)
 
-def updateIndex(file_path, mode):
+
+def syncWritten(dir):
     '''
-    input: path of the file to update
-    output: update the index file
+    input: dir: a dir on the file system the files were written to
+    output: the files recorded since the last call are synced with one
+            syncfs, or one by one with their dirs if there is no syncfs
     '''
-    # get path to index file
-    index_path = path.join(getGitParentPath(), '.lgit/index')
-    # get file name from the path
-    file_name = getIndexFileName(file_path)
-    print(file_name)
-    # idx_content is a list from the index content
-    idx_content = getFileContent(index_path)
-    # get the line content from the list
-    line_idx = detectLineOfFile(file_name, idx_content)
-    line = idx_content[line_idx]
+    global LIBC
+    if not FSYNC_ENABLED or not SYNC_PENDING:
+        SYNC_PENDING.clear()
+        return
+    if LIBC is None:
+        LIBC = ctypes.CDLL(find_library('c'), use_errno=True)
+    if getattr(LIBC, 'syncfs', None) is not None:
+        fd = openFd(dir or '.', O_RDONLY)
+        try:
+            synced = LIBC.syncfs(fd) == 0
+        finally:
+            close(fd)
+        if synced:
+            SYNC_PENDING.clear()
+            return
+    dirs = set()
+    while SYNC_PENDING:
+        file_path = SYNC_PENDING.pop()
+        dirs.add(path.dirname(file_path))
+        try:
+            fd = openFd(file_path, O_RDONLY)
+        except FileNotFoundError:
+            # replaced or removed since, nothing refers to it
+            continue
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+    for dir in dirs:
+        syncDir(dir)
+
+
+# Make a rename in a dir durable
+def syncDir(dir):
+    if not FSYNC_ENABLED:
+        return
+    fd = openFd(dir or '.', O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
 
-    if mode == 'status':
-        replace_line = updateWithStatus(line, file_path)
-        idx_content[line_idx] = replace_line
-    elif mode == 'rm':
-        idx_content.remove(line)
-    # rewrite all the content of index file
-    writeFileContent(index_path, ''.join(idx_content))
+# Suffix of loose objects stored compressed with zlib
+COMPRESSED_SUFFIX = '.z'
+# Suffix of loose objects stored as a delta against another object
+DELTA_SUFFIX = '.delta'
+# Suffix of loose objects stored as a list of chunks
+CHUNKS_SUFFIX = '.chunks'
+
+
+# Get the path of an object from its SHA1
+def getObjectPath(lgit_path, file_hash):
+    return path.join(lgit_path, 'objects', file_hash[:2], file_hash[2:])
+
+
+def hasObject(lgit_path, file_hash):
+    object_path = getObjectPath(lgit_path, file_hash)
+    return (path.isfile(object_path) or
+            path.isfile(object_path + COMPRESSED_SUFFIX) or
+            path.isfile(object_path + DELTA_SUFFIX) or
+            path.isfile(object_path + CHUNKS_SUFFIX) or
+            findPackedObject(lgit_path, file_hash) is not None)
+
+
+# Read an opened file in chunks, decompressing them if needed
+def readFileChunks(f, decompressor=None, length=None):
+    BUF_SIZE = 65536
+    while length is None or length > 0:
+        size = BUF_SIZE if length is None else min(BUF_SIZE, length)
+        data = f.read(size)
+        if not data:
+            break
+        if length is not None:
+            length -= len(data)
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        if data:
+            yield data
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data:
+            yield data
 
 
-def getIndexFileName(file_path):
+def readObjectChunks(lgit_path, file_hash):
     '''
-    input: file_path: abspath to the file
-    output: file_name saved in index file
+    input: SHA1 of an object
+    output: generator of the uncompressed content of the object in chunks,
+            loose objects are looked up first, then the packs,
+            raise FileNotFoundError if the object is not stored
     '''
-    lgit_parent_path = getGitParentPath()
-    file_name = file_path[len(lgit_parent_path)+1:]
-    return file_name
+    object_path = getObjectPath(lgit_path, file_hash)
+    try:
+        f = open(object_path, 'rb')
+        decompressor = None
+    except FileNotFoundError:
+        try:
+            f = open(object_path + COMPRESSED_SUFFIX, 'rb')
+            decompressor = zlib.decompressobj()
+        except FileNotFoundError:
+            if path.isfile(object_path + DELTA_SUFFIX):
+                yield readDeltaObject(lgit_path, file_hash)
+                return
+            if path.isfile(object_path + CHUNKS_SUFFIX):
+                yield from readChunkedObject(lgit_path, file_hash)
+                return
+            packed = findPackedObject(lgit_path, file_hash, rescan=True)
+            if packed is None:
+                raise FileNotFoundError('object {} not found'.format(
+                                        file_hash))
+            pack, offset, length, kind = packed
+            if kind == OBJECT_KIND_DELTA:
+                yield readDeltaObject(lgit_path, file_hash)
+                return
+            if kind == OBJECT_KIND_CHUNKS:
+                yield from readChunkedObject(lgit_path, file_hash)
+                return
+            f = open(pack.pack_path, 'rb')
+            f.seek(offset)
+            with f:
+                yield from readFileChunks(f, zlib.decompressobj(), length)
+            return
+    with f:
+        yield from readFileChunks(f, decompressor)
 
 
-def isInIndex(file_name, idx_content):
-    confirm = False
-    for line in idx_content:
-        if file_name in line:
-            confirm = True
-            break
-    return confirm
+def readObject(lgit_path, file_hash):
+    return b''.join(readObjectChunks(lgit_path, file_hash))
 
 
-def isTrackedFile(file_path):
-    # get path to index file
-    index_path = path.join(getGitParentPath(), '.lgit/index')
-    # get file name from the path
-    file_name = getIndexFileName(file_path)
-    # idx_content is a list from the index content
-    idx_content = getFileContent(index_path)
-    return isInIndex(file_name, idx_content)
+def storeObjectData(lgit_path, data, level=0):
+    '''
+    input: data: bytes of an object built in memory (tree, commit)
+    output: SHA1 of the data, which is written to objects if not stored yet
+    '''
+    file_hash = sha1(data).hexdigest()
+    if hasObject(lgit_path, file_hash):
+        return file_hash
+    object_file_path = getObjectPath(lgit_path, file_hash)
+    if level:
+        data = zlib.compress(data, level)
+        object_file_path += COMPRESSED_SUFFIX
+    writeLooseObject(lgit_path, object_file_path, data)
+    return file_hash
 
 
-def getTrackAndUntrack(file_paths):
-    untracked_files = []
-    tracked_files = []
-    for path in file_paths:
-        if isTrackedFile(path):
-            tracked_files.append(path)
+def writeLooseObject(lgit_path, object_file_path, data):
+    '''
+    input: object_file_path: path of the object with its suffix; data: its
+           bytes as stored
+    output: data is written aside then renamed into place, the temp file
+            is removed if that fails
+    '''
+    makedirs(path.dirname(object_file_path), exist_ok=True)
+    fd, tmp_path = mkstemp(prefix='tmp_obj_',
+                           dir=path.join(lgit_path, 'objects'))
+    try:
+        with fdopen(fd, 'wb') as f:
+            f.write(data)
+            # objects are never modified once written
+            fchmod(f.fileno(), 0o444)
+        rename(tmp_path, object_file_path)
+    except BaseException:
+        unlink(tmp_path)
+        raise
+    markWritten(object_file_path)
+
+
+def updateObjectsWithAdd(lgit_path, file, level=0, base_hash=None):
+    '''
+    input: file: path to the file to store; level: zlib level, 0 to store
+           the file uncompressed; base_hash: SHA1 of the committed version
+           of the file, to store it as a delta against
+    output: SHA1 of the file, which is hashed while its bytes are copied to
+            a temp file in objects, then renamed into place
+    '''
+    BUF_SIZE = 65536
+    SHA1 = sha1()
+    compressor = zlib.compressobj(level) if level else None
+    objects_path = path.join(lgit_path, 'objects')
+    chunks = None
+    size = 0
+    fd, tmp_path = mkstemp(prefix='tmp_obj_', dir=objects_path)
+    try:
+        with open(file, 'rb') as src, fdopen(fd, 'wb') as dst:
+            # the content is kept for a delta if the file is small enough
+            if (base_hash is not None and
+                    fstat(src.fileno()).st_size <= DELTA_MAX_SIZE):
+                chunks = []
+            while True:
+                data = src.read(BUF_SIZE)
+                if not data:
+                    break
+                # the name of an object is the SHA1 of its uncompressed data
+                SHA1.update(data)
+                size += len(data)
+                if chunks is not None:
+                    if size > DELTA_MAX_SIZE:
+                        chunks = None
+                    else:
+                        chunks.append(data)
+                if compressor is not None:
+                    data = compressor.compress(data)
+                dst.write(data)
+            if compressor is not None:
+                dst.write(compressor.flush())
+            # objects are never modified once written
+            fchmod(dst.fileno(), 0o444)
+        file_hash = SHA1.hexdigest()
+        object_file_path = getObjectPath(lgit_path, file_hash)
+        if compressor is not None:
+            object_file_path += COMPRESSED_SUFFIX
+        if hasObject(lgit_path, file_hash):
+            unlink(tmp_path)
+        elif (chunks is not None and size >= DELTA_MIN_SIZE and
+                storeDelta(lgit_path, file_hash, b''.join(chunks),
+                           base_hash, level)):
+            unlink(tmp_path)
         else:
-            untracked_files.append(path)
-    return tracked_files, untracked_files
+            makedirs(path.dirname(object_file_path), exist_ok=True)
+            rename(tmp_path, object_file_path)
+            markWritten(object_file_path)
+        return file_hash
+    except BaseException:
+        if path.exists(tmp_path):
+            unlink(tmp_path)
+        raise
 
 
-def isStagedFile(line_idx):
-    # get hash of added field
-    field2 = getInfoOfField(line_idx, 2)
-    # get hash of commited field
-    field3 = getInfoOfField(line_idx, 3)
-    # if added field and commited field is difference: means staged
-    return field2 != field3
+'''_____________________GIT DELTA_________________________________'''
 
 
-def isUnstagedFile(line_idx):
-    # get hash of current file
-    field1 = getInfoOfField(line_idx, 1)
-    # get hash of added field
-    field2 = getInfoOfField(line_idx, 2)
-    # if hash of current file and added is difference: means unstaged
-    return field1 != field2
+# A delta object is a zlib stream of a header line
+# 'delta <SHA1 of base> <size of content> <depth>', then ops rebuilding the
+# content from the lines of its base: 'c <first line> <count>' copies lines
+# of the base, 'i <length>' is followed by bytes to insert
+DELTA_MIN_SIZE = 64 * 1024
+# Bigger files are stored whole: their delta is built in memory, once per
+# worker thread of add
+DELTA_MAX_SIZE = 8 * 1024 * 1024
+# Longest chain of deltas to read to rebuild an object
+DELTA_MAX_DEPTH = 10
+# Copies shorter than this cost more than inserting the line
+DELTA_MIN_COPY = 16
 
 
-def getStagedAndUnstaged():
-    index_path = path.join(getGitParentPath(), '.lgit/index')
-    idx_content = getFileContent(index_path)
-    staged_files = []
-    unstaged_files = []
-    for line in idx_content:
-        if isStagedFile(line):
-            staged_files.append(getInfoOfField(line, 4))
-        if isUnstagedFile(line):
-            unstaged_files.append(getInfoOfField(line, 4))
-    return staged_files, unstaged_files
+# Contents of recently read delta bases by SHA1, bounded in bytes
+class ObjectCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.objects = OrderedDict()
+        self.lock = Lock()
 
+    def get(self, file_hash):
+        with self.lock:
+            data = self.objects.get(file_hash)
+            if data is not None:
+                self.objects.move_to_end(file_hash)
+            return data
 
-def isCommitNoChange():
-    index_path = path.join(getGitParentPath(), '.lgit/index')
-    idx_content = getFileContent(index_path)
-    nochange = True
-    for line in idx_content:
-        hash_field2 = getInfoOfField(line, 2)
-        hash_field3 = getInfoOfField(line, 3)
-        if hash_field2 != hash_field3:
-            nochange = False
-            break
-    return nochange
+    def put(self, file_hash, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if file_hash in self.objects:
+                return
+            self.objects[file_hash] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old_data = self.objects.popitem(last=False)
+                self.size -= len(old_data)
 
 
-def printStaged(staged_files):
-    print("Changes to be committed:")
-    print("  (use \"./lgit.py reset HEAD ...\" to unstage)")
-    print()
-    for file_path in staged_files:
-        abspath = path.join(getGitParentPath(), file_path)
-        rel_path = path.relpath(abspath)
-        print('\tmodified:  %s' % rel_path)
-    print()
+DELTA_BASE_CACHE = ObjectCache(64 * 1024 * 1024)
 
 
-def printUnstaged(unstaged_files):
-    print("Changes not staged for commit:")
-    print("  (use \"./lgit.py add ...\" to update what will be committed)")
-    print("  (use \"./lgit.py checkout -- ...\" to discard changes\
- in working directory")
-    print()
-    for file_path in unstaged_files:
-        abspath = path.join(getGitParentPath(), file_path)
-        rel_path = path.relpath(abspath)
-        print('\tmodified:  %s' % rel_path)
-    print()
+def makeDelta(base, data):
+    '''
+    output: ops rebuilding data from the lines of base, each line of data
+            is looked up in base, a match is extended as far as it goes
+    '''
+    base_lines = base.splitlines(keepends=True)
+    first_pos = {}
+    for pos, line in enumerate(base_lines):
+        first_pos.setdefault(line, pos)
+    lines = data.splitlines(keepends=True)
+    ops = []
+    inserted = []
+    pos = 0
+    next_base = 0
+    while pos < len(lines):
+        line = lines[pos]
+        # prefer going on where the last copy stopped
+        if next_base < len(base_lines) and base_lines[next_base] == line:
+            start = next_base
+        else:
+            start = first_pos.get(line)
+        count = 0
+        if start is not None:
+            count = 1
+            while (pos + count < len(lines) and
+                   start + count < len(base_lines) and
+                   lines[pos + count] == base_lines[start + count]):
+                count += 1
+        if not count or (count == 1 and len(line) < DELTA_MIN_COPY):
+            inserted.append(line)
+            pos += 1
+            continue
+        if inserted:
+            inserted = b''.join(inserted)
+            ops.append(b'i %d\n' % len(inserted) + inserted)
+            inserted = []
+        ops.append(b'c %d %d\n' % (start, count))
+        pos += count
+        next_base = start + count
+    if inserted:
+        inserted = b''.join(inserted)
+        ops.append(b'i %d\n' % len(inserted) + inserted)
+    return b''.join(ops)
 
 
-def printUntracked(untracked_files):
-    print("Untracked files:")
-    print("  (use \"./lgit.py add <file>...\" to include\
- in what will be committed)")
-    print()
-    for file_path in untracked_files:
-        rel_path = path.relpath(file_path)
-        print('\t' + rel_path)
-    print()
+def applyDelta(base, ops, size):
+    base_lines = base.splitlines(keepends=True)
+    out = []
+    pos = 0
+    while pos < len(ops):
+        end = ops.index(b'\n', pos)
+        op = ops[pos:end].split()
+        pos = end + 1
+        if op[0] == b'c':
+            start, count = int(op[1]), int(op[2])
+            out.extend(base_lines[start:start + count])
+        else:
+            length = int(op[1])
+            out.append(ops[pos:pos + length])
+            pos += length
+    data = b''.join(out)
+    if len(data) != size:
+        raise ValueError('corrupt delta object')
+    return data
 
 
-def printHeader(git_path):
-    print('On branch master\n')
-    if listdir(path.join(git_path, '.lgit/commits')):
-        print("Your branch is up-to-date with 'origin/master'.\n")
-    else:
-        print("No commits yet\n")
+# Read the header and ops of a delta object, loose or packed
+def readDeltaPayload(lgit_path, file_hash):
+    object_path = getObjectPath(lgit_path, file_hash) + DELTA_SUFFIX
+    try:
+        with open(object_path, 'rb') as f:
+            return zlib.decompress(f.read())
+    except FileNotFoundError:
+        packed = findPackedObject(lgit_path, file_hash, rescan=True)
+        if packed is None or packed[3] != OBJECT_KIND_DELTA:
+            raise
+        pack, offset, length, _ = packed
+        with open(pack.pack_path, 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
 
 
-def printTailer(git_path):
-    if not (listdir(path.join(git_path, '.lgit/commits')) and
-            listdir(path.join(git_path, '.lgit/objects'))):
-        print("nothing added to commit but untracked files present\
- (use \"./lgit.py add\" to track)")
-    elif isCommitNoChange():
-        print("no changes added to commit (use \"./lgit.py add and/or\
- \"./lgit.py commit -a\")")
+def parseDeltaHeader(payload):
+    '''
+    output: (SHA1 of the base, size of the content, depth, offset of ops)
+    '''
+    end = payload.index(b'\n')
+    _, base_hash, size, depth = payload[:end].split()
+    return base_hash.decode(), int(size), int(depth), end + 1
 
 
-def showStatus(git_path, staged_files, unstaged_files, untracked_files):
-    printHeader(git_path)
-    if staged_files:
-        printStaged(staged_files)
-    if unstaged_files:
-        printUnstaged(unstaged_files)
-    if untracked_files:
-        printUntracked(untracked_files)
-    printTailer(git_path)
+def isDeltaObject(lgit_path, file_hash):
+    if path.isfile(getObjectPath(lgit_path, file_hash) + DELTA_SUFFIX):
+        return True
+    packed = findPackedObject(lgit_path, file_hash)
+    return packed is not None and packed[3] == OBJECT_KIND_DELTA
 
 
-def checkGitStt():
-    git_path = getGitParentPath()
-    # get all filename in git directory
-    file_paths = getDirRecursively(git_path)
-    tracked_files, untracked_files = getTrackAndUntrack(file_paths)
+# Get the number of deltas to read to rebuild an object, 0 if it is whole
+def getDeltaDepth(lgit_path, file_hash):
+    if not isDeltaObject(lgit_path, file_hash):
+        return 0
+    return parseDeltaHeader(readDeltaPayload(lgit_path, file_hash))[2]
 
-    if tracked_files:
-        for file_path in tracked_files:
-            updateIndex(file_path, 'status')
 
-    staged_files, unstaged_files = getStagedAndUnstaged()
-    showStatus(git_path, staged_files, unstaged_files, untracked_files)
+# Read an object used as a delta base, through the cache
+def readBaseObject(lgit_path, file_hash):
+    data = DELTA_BASE_CACHE.get(file_hash)
+    if data is None:
+        data = readObject(lgit_path, file_hash)
+        DELTA_BASE_CACHE.put(file_hash, data)
+    return data
 
 
-'''_____________________GIT LS-FILES_________________________________'''
+def readDeltaObject(lgit_path, file_hash):
+    payload = readDeltaPayload(lgit_path, file_hash)
+    base_hash, size, _, offset = parseDeltaHeader(payload)
+    base = readBaseObject(lgit_path, base_hash)
+    return applyDelta(base, memoryview(payload)[offset:].tobytes(), size)
 
 
-def getPathFromCurDir(path):
-    cur_dir = getcwd()
-    new_path = path[len(cur_dir)+1:]
-    return new_path
+def storeDelta(lgit_path, file_hash, data, base_hash, level=0):
+    '''
+    output: True if data was stored as a delta against the base, which is
+            only done if the base is there, the chain is not too long and
+            the delta is less than half the size of data
+    '''
+    try:
+        depth = getDeltaDepth(lgit_path, base_hash) + 1
+        if depth > DELTA_MAX_DEPTH:
+            return False
+        ops = makeDelta(readBaseObject(lgit_path, base_hash), data)
+    except (FileNotFoundError, ValueError):
+        return False
+    if len(ops) * 2 > len(data):
+        return False
+    payload = b'delta %s %d %d\n' % (base_hash.encode(), len(data), depth)
+    object_file_path = getObjectPath(lgit_path, file_hash) + DELTA_SUFFIX
+    writeLooseObject(lgit_path, object_file_path, zlib.compress(
+        payload + ops, level or zlib.Z_DEFAULT_COMPRESSION))
+    return True
 
 
-def lsFileGit():
-    # get all file path in current directory
-    file_paths = getDirRecursively(getcwd())
-    list_file = []
-    # get new file path relative to current directory
-    for path in file_paths:
-        if isTrackedFile(path):
-            new_path = getPathFromCurDir(path)
-            list_file.append(new_path)
-    # print the file list
-    for path in sorted(list_file):
-        print(path)
+'''_____________________GIT CHUNKS_________________________________'''
 
 
-'''__________________GIT LOG_________________________________'''
+# A big file can be cut in chunks where its content says so, the chunks
+# are objects and the file is stored under its SHA1 as a zlib stream of
+# 'chunks <size>' then a line '<SHA1> <size>' per chunk. A change only
+# changes the chunks around it, and chunks shared by files are stored once.
+CHUNK_MIN = 16 * 1024
+CHUNK_AVG = 64 * 1024
+CHUNK_MAX = 256 * 1024
+# FastCDC: a gear hash of the last 64 bytes, a cut is made where its top
+# bits are zeros, with more bits before the average size and fewer after.
+# The hash is a Python loop over the bytes, about 8 MB/s, but as it only
+# depends on the last 64 bytes the places it allows a cut are found in
+# worker processes, each on a part of the file, then the cuts are chosen
+# from them in order.
+GEAR = [int.from_bytes(sha1(b'lgit gear %d' % idx).digest()[:8], 'big')
+        for idx in range(256)]
+CHUNK_MASK_SMALL = ((1 << 18) - 1) << 46
+CHUNK_MASK_LARGE = ((1 << 14) - 1) << 50
+MASK_64 = (1 << 64) - 1
+# Bytes scanned for cuts by a worker at a time
+CHUNK_SCAN_SIZE = 2 * 1024 * 1024
+# Worker processes scanning for cuts, shared by the files being added
+CHUNK_POOL = None
+CHUNK_POOL_LOCK = Lock()
 
 
-# Get the sorted list of files in commits dir
-def getCommitsFiles(lgit_path):
-    commits_path = path.join(lgit_path, 'commits')
-    paths = []
-    for root, _, files in walk(commits_path):
-        for file in files:
-            file_path = path.join(root, file)
-            paths.append(file_path)
-    return sorted((paths), key=lambda x: float(x.split('/')[-1]), reverse=True)
+# Get the size given as bytes, or with a K, M or G suffix
+def parseSize(size):
+    size = size.strip().upper()
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if size and size[-1] in units:
+        return int(size[:-1]) * units[size[-1]]
+    return int(size)
 
 
-def getReadableTime(file):
-    ts = path.getmtime(file)
-    return datetime.fromtimestamp(float(ts)).strftime('%a %b %d %H:%M:%S %Y')
+def findCutCandidates(data, offset):
+    '''
+    input: data: bytes of a file from offset, the first 63 bytes are only
+           hashed, they are the window of the next byte
+    output: (ends, small): ends of the data after which the hash of the
+            last 64 bytes allows a cut with CHUNK_MASK_LARGE, and for each
+            one if it does with CHUNK_MASK_SMALL too
+    '''
+    gear = GEAR
+    mask = MASK_64
+    ends = []
+    small = []
+    hash = 0
+    rest = iter(data)
+    for byte in islice(rest, 63):
+        hash = ((hash << 1) + gear[byte]) & mask
+    # iterating the bytes is about twice as fast as indexing them, the
+    # position of a cut is found from the length left in the iterator
+    end = offset + len(data)
+    for byte in rest:
+        hash = ((hash << 1) + gear[byte]) & mask
+        if not hash & CHUNK_MASK_LARGE:
+            ends.append(end - length_hint(rest))
+            small.append(not hash & CHUNK_MASK_SMALL)
+    return ends, small
 
 
-def logGit(lgit_path):
-    commit_paths = getCommitsFiles(lgit_path)
-    if not commit_paths:
-        print("fatal: your current branch 'master' does" +
-              " not have any commits yet")
-    else:
-        for path in commit_paths:
-            path_content = getFileContent(path)
-            print('commit', path.split('/')[-1])
-            print('Author:', path_content[0].strip('\n'))
-            print('Date: {}\n'.format(getReadableTime(path)))
-            print('\t{}\n'.format(path_content[3]))
+def getChunkPool():
+    global CHUNK_POOL
+    with CHUNK_POOL_LOCK:
+        if CHUNK_POOL is None:
+            CHUNK_POOL = ProcessPoolExecutor(max_workers=cpu_count())
+        return CHUNK_POOL
 
 
-'''_____________________GIT RM_________________________________'''
+def findAllCutCandidates(data):
+    '''
+    output: (ends, small) of findCutCandidates for all of data, its parts
+            are scanned in the worker processes, each with the 63 bytes
+            before it
+    '''
+    parts = []
+    offsets = []
+    for lo in range(0, len(data), CHUNK_SCAN_SIZE):
+        offset = max(lo - 63, 0)
+        parts.append(data[offset:lo + CHUNK_SCAN_SIZE])
+        offsets.append(offset)
+    results = getChunkPool().map(findCutCandidates, parts, offsets)
+    ends = []
+    small = []
+    for part_ends, part_small in results:
+        ends.extend(part_ends)
+        small.extend(part_small)
+    return ends, small
 
 
-def rmIndex(file, lgit_path):
-    index_path = path.join(lgit_path, 'index')
-    index_file_path = getIndexFileName(path.abspath(file))
-    index_content = getFileContent(index_path)
-    idx_line_file = detectLineOfFile(index_file_path, index_content)
-    if idx_line_file is not None:
-        del index_content[idx_line_file]
-        new_index_content = ''.join(index_content)
-        writeFileContent(index_path, new_index_content)
-        return True
-    else:
-        print("fatal: pathspec '{}' did not match any files".format(file))
-        return False
+def findChunkEnd(data, start, end, candidates=None):
+    '''
+    input: data: bytes with a chunk starting at start, and end the end of
+           the data read so far, which is at least CHUNK_MAX further
+           unless the file ends there; candidates: (ends, small) of
+           findAllCutCandidates for data, None to hash the chunk here
+    output: end of the chunk
+    '''
+    size = min(end - start, CHUNK_MAX)
+    if size <= CHUNK_MIN:
+        return start + size
+    normal_end = start + min(CHUNK_AVG, size)
+    chunk_end = start + size
+    if candidates is None:
+        return scanChunkEnd(data, start + CHUNK_MIN, normal_end, chunk_end)
+    ends, small = candidates
+    # the hash starts after CHUNK_MIN, its first 63 bytes are not a whole
+    # window so the cuts there are not candidates, they are hashed here
+    gear = GEAR
+    hash = 0
+    pos = start + CHUNK_MIN
+    window_end = min(pos + 63, chunk_end)
+    while pos < window_end:
+        hash = ((hash << 1) + gear[data[pos]]) & MASK_64
+        pos += 1
+        if not hash & (CHUNK_MASK_SMALL if pos <= normal_end else
+                       CHUNK_MASK_LARGE):
+            return pos
+    idx = bisect_left(ends, pos + 1)
+    while idx < len(ends) and ends[idx] <= chunk_end:
+        if ends[idx] > normal_end or small[idx]:
+            return ends[idx]
+        idx += 1
+    return chunk_end
 
 
-def rmGit(file, lgit_path):
-    file_path = path.abspath(file)
-    if rmIndex(file, lgit_path):
-        unlink(file_path)
+def scanChunkEnd(data, pos, normal_end, chunk_end):
+    '''
+    output: end of the chunk whose hash starts at pos, found by hashing its
+            bytes one after the other
+    '''
+    gear = GEAR
+    mask = MASK_64
+    hash = 0
+    rest = iter(data[pos:normal_end])
+    for byte in rest:
+        hash = ((hash << 1) + gear[byte]) & mask
+        if not hash & CHUNK_MASK_SMALL:
+            return normal_end - length_hint(rest)
+    rest = iter(data[normal_end:chunk_end])
+    for byte in rest:
+        hash = ((hash << 1) + gear[byte]) & mask
+        if not hash & CHUNK_MASK_LARGE:
+            return chunk_end - length_hint(rest)
+    return chunk_end
 
 
-'''_____________________GIT CONFIG_________________________________'''
+def iterFileChunks(f):
+    '''
+    output: generator of the content defined chunks of an opened file
+    '''
+    workers = cpu_count() or 1
+    block_size = CHUNK_SCAN_SIZE * workers
+    data = b''
+    start = 0
+    eof = False
+    while not eof or start < len(data):
+        # a block of the file is scanned at once, the end of the last one
+        # that is too short for a chunk is scanned again with it
+        parts = [data[start:]]
+        size = len(parts[0])
+        while not eof and size < block_size:
+            read_data = f.read(CHUNK_SCAN_SIZE)
+            eof = not read_data
+            parts.append(read_data)
+            size += len(read_data)
+        data = b''.join(parts)
+        start = 0
+        # with one core the bytes before CHUNK_MIN of each chunk are not
+        # hashed at all, which is faster than scanning them for candidates
+        candidates = None
+        if workers > 1 and len(data) > CHUNK_SCAN_SIZE:
+            candidates = findAllCutCandidates(data)
+        while start < len(data) and (eof or len(data) - start >= CHUNK_MAX):
+            end = findChunkEnd(data, start, len(data), candidates)
+            yield data[start:end]
+            start = end
 
 
-def configGit(author, lgit_path):
-    config_path = path.join(lgit_path, 'config')
-    writeFileContent(config_path, author + '\n')
+def storeChunkedFile(lgit_path, file, level=0):
+    '''
+    output: SHA1 of the file, its chunks are stored as objects if not
+            stored yet, then its list of chunks under the SHA1
+    '''
+    SHA1 = sha1()
+    lines = []
+    size = 0
+    with open(file, 'rb') as f:
+        for chunk in iterFileChunks(f):
+            SHA1.update(chunk)
+            size += len(chunk)
+            lines.append(b'%s %d\n' % (storeObjectData(
+                lgit_path, chunk, level).encode(), len(chunk)))
+    file_hash = SHA1.hexdigest()
+    if hasObject(lgit_path, file_hash):
+        return file_hash
+    content = b'chunks %d\n' % size + b''.join(lines)
+    object_file_path = getObjectPath(lgit_path, file_hash) + CHUNKS_SUFFIX
+    writeLooseObject(lgit_path, object_file_path, zlib.compress(
+        content, level or zlib.Z_DEFAULT_COMPRESSION))
+    return file_hash
+
+
+def readChunkList(lgit_path, file_hash):
+    '''
+    output: list of (SHA1, size) of the chunks of a chunked object
+    '''
+    object_path = getObjectPath(lgit_path, file_hash) + CHUNKS_SUFFIX
+    try:
+        with open(object_path, 'rb') as f:
+            content = zlib.decompress(f.read())
+    except FileNotFoundError:
+        packed = findPackedObject(lgit_path, file_hash, rescan=True)
+        if packed is None or packed[3] != OBJECT_KIND_CHUNKS:
+            raise
+        pack, offset, length, _ = packed
+        with open(pack.pack_path, 'rb') as f:
+            f.seek(offset)
+            content = zlib.decompress(f.read(length))
+    chunks = []
+    for line in content.decode().splitlines()[1:]:
+        chunk_hash, size = line.split()
+        chunks.append((chunk_hash, int(size)))
+    return chunks
+
+
+def readChunkedObject(lgit_path, file_hash):
+    for chunk_hash, _ in readChunkList(lgit_path, file_hash):
+        yield from readObjectChunks(lgit_path, chunk_hash)
+
+
+# Hash a file and store it in objects, safe to run in worker threads
+def hashAndStoreFile(file, file_name, lgit_path, index, level=0,
+                     chunk_threshold=0):
+    '''
+    input: file: path to the file to add; file_name: its name in index;
+           level: zlib level of the stored object; chunk_threshold: size
+           from which the file is stored in chunks, 0 to never chunk it
+    output: (stat, SHA1) of the file, SHA1 is None if it can not be read
+    '''
+    # stat before reading so a change while hashing shows up next time
+    try:
+        file_stat = stat(file)
+    except FileNotFoundError:
+        print("fatal: pathspec '{}' did not match any files".format(file))
+        return None, None
+    # An unchanged file whose object is stored is not read again
+    entry = index.get(file_name)
+    if (entry is not None and entry.current_hash == entry.add_hash and
+            index.isUpToDate(entry, file_stat) and
+            hasObject(lgit_path, entry.add_hash)):
+        return file_stat, entry.add_hash
+    # a new version is stored as a delta against the committed one
+    base_hash = entry.commit_hash if entry is not None else None
+    try:
+        if chunk_threshold and file_stat.st_size >= chunk_threshold:
+            return file_stat, storeChunkedFile(lgit_path, file, level)
+        return file_stat, updateObjectsWithAdd(lgit_path, file, level,
+                                               base_hash)
+    except FileNotFoundError:
+        print("fatal: pathspec '{}' did not match any files".format(file))
+        return None, None
+
+
+# Get the name saved in the index of a file to add
+# Update the entry of an added file in the index
+def updateIndexWithAdd(file_name, file_stat, file_hash, index):
+    if file_hash is None:
+        return
+    entry = index.get(file_name)
+    commit_hash = entry.commit_hash if entry is not None else None
+    entry = IndexEntry(None, file_hash, file_hash, commit_hash, file_name)
+    index.refreshStat(entry, file_stat)
+
+
+# lgit add a file
+def addGitFile(file, repo):
+    index = repo.getIndex(write=True)
+    file_name = getIndexFileName(path.abspath(file), repo.root)
+    file_stat, file_hash = hashAndStoreFile(file, file_name, repo.lgit_path,
+                                            index, repo.getCompressionLevel(),
+                                            repo.getChunkThreshold())
+    updateIndexWithAdd(file_name, file_stat, file_hash, index)
+
+
+'''_____________________GIT IGNORE_________________________________'''
+
+
+IGNORE_FILE = '.lgitignore'
+
+
+# Translate a glob of an ignore file into a regex
+def translateIgnorePattern(pattern):
+    regex = []
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if pattern.startswith('**/', idx):
+            regex.append('(?:.*/)?')
+            idx += 3
+            continue
+        if pattern.startswith('**', idx):
+            regex.append('.*')
+            idx += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[' and ']' in pattern[idx + 2:]:
+            end = pattern.index(']', idx + 2)
+            char_class = pattern[idx + 1:end].replace('\\', '\\\\')
+            if char_class.startswith('!'):
+                char_class = '^' + char_class[1:]
+            regex.append('[' + char_class + ']')
+            idx = end
+        elif char == '\\' and idx + 1 < len(pattern):
+            idx += 1
+            regex.append(re.escape(pattern[idx]))
+        else:
+            regex.append(re.escape(char))
+        idx += 1
+    return ''.join(regex)
+
+
+# The rules of one ignore file, compiled once
+class IgnoreRules:
+    def __init__(self, base, lines):
+        '''
+        input: base: dir of the ignore file relative to the lgit parent,
+                     '' for the top dir; lines: lines of the ignore file
+        '''
+        prefix = re.escape(base + '/') if base else ''
+        # changes when the ignore file changes, for the untracked cache
+        self.sig = sha1('\n'.join([base] + lines).encode(
+            errors='surrogateescape')).hexdigest()
+        # (regex, negate, dir_only) in the order of the file
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # a pattern with a slash is relative to the ignore file dir,
+            # otherwise it matches a name at any depth below it
+            if '/' in line:
+                regex = prefix + translateIgnorePattern(line.lstrip('/'))
+            else:
+                regex = prefix + '(?:.*/)?' + translateIgnorePattern(line)
+            self.rules.append((re.compile(regex + '$'), negate, dir_only))
+        # without negation any match ignores, so one regex is enough
+        self.combined = None
+        if not any(negate for _, negate, _ in self.rules):
+            self.combined = [
+                re.compile('|'.join('(?:%s)' % regex.pattern
+                                    for regex, _, only in self.rules
+                                    if not only or is_dir) or '(?!)')
+                for is_dir in (False, True)]
+
+    @classmethod
+    def fromFile(cls, base, ignore_path):
+        try:
+            with open(ignore_path, 'r', errors='surrogateescape') as f:
+                return cls(base, f.readlines())
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def match(self, rel_path, is_dir):
+        '''
+        input: rel_path: path relative to the lgit parent
+        output: True if ignored, False if re-included by a '!' rule,
+                None if no rule of this file matches
+        '''
+        if self.combined is not None:
+            return True if self.combined[is_dir].match(rel_path) else None
+        # the last matching rule wins
+        for regex, negate, dir_only in reversed(self.rules):
+            if (is_dir or not dir_only) and regex.match(rel_path):
+                return not negate
+        return None
+
+
+def isIgnored(rel_path, is_dir, ignore_stack):
+    '''
+    input: rel_path: path relative to the lgit parent;
+           ignore_stack: IgnoreRules of the dirs above, top dir first
+    output: True if the path is ignored
+    '''
+    # rules of a deeper ignore file take precedence
+    for rules in reversed(ignore_stack):
+        matched = rules.match(rel_path, is_dir)
+        if matched is not None:
+            return matched
+    return False
+
+
+# Get the IgnoreRules of the dirs from the lgit parent down to above dir
+def getIgnoreStack(dir, lgit_parent_path):
+    rel_dir = path.relpath(path.abspath(dir), lgit_parent_path)
+    if rel_dir == '.':
+        return []
+    # the ignore file of dir itself is read when walking it
+    parts = rel_dir.split('/')
+    bases = [''] + ['/'.join(parts[:idx]) for idx in range(1, len(parts))]
+    ignore_stack = []
+    for base in bases:
+        rules = IgnoreRules.fromFile(base, path.join(lgit_parent_path, base,
+                                                     IGNORE_FILE))
+        if rules is not None:
+            ignore_stack.append(rules)
+    return ignore_stack
+
+
+# Get the sig of the ignore rules of a dir from the sig of its parent
+def getIgnoreSig(parent_sig, rules):
+    if rules is None:
+        return parent_sig
+    return sha1((parent_sig + rules.sig).encode()).hexdigest()
+
+
+def listDir(dir, rel_dir, ignore_stack):
+    '''
+    List dir with scandir, which gives the type of entries without a stat
+    output: (names of files, names of sub dirs) not ignored, None if dir
+            can not be listed
+    '''
+    file_names = []
+    sub_dir_names = []
+    try:
+        entries = list(scandir(dir))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+    for entry in entries:
+        rel_path = rel_dir + '/' + entry.name if rel_dir else entry.name
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            continue
+        if is_dir:
+            # symlinks to dirs are not followed, like os.walk
+            if (entry.name != '.lgit' and not entry.is_symlink() and
+                    not isIgnored(rel_path, True, ignore_stack)):
+                sub_dir_names.append(entry.name)
+        elif not isIgnored(rel_path, False, ignore_stack):
+            file_names.append(entry.name)
+    return file_names, sub_dir_names
+
+
+def walkDir(dir, rel_dir, ignore_stack, paths, cache=None, sig=''):
+    '''
+    Walk dir recursively, ignored dirs are pruned before descending into
+    them. With an UntrackedCache, a dir whose mtime did not change is not
+    listed again.
+    input: sig: sig of the ignore rules in ignore_stack
+    '''
+    cached = None
+    if cache is not None:
+        # a dir the fsmonitor saw no change in is not even stat'ed
+        cached = cache.lookupUnchanged(rel_dir, sig)
+        if cached is not None:
+            dir_mtime = cached.mtime_ns
+        else:
+            try:
+                dir_mtime = stat(dir).st_mtime_ns
+            except OSError:
+                return
+            cached = cache.lookup(rel_dir, dir_mtime, sig)
+    rules = None
+    if cached is None or cached.has_ignore_file:
+        rules = IgnoreRules.fromFile(rel_dir, path.join(dir, IGNORE_FILE))
+    if rules is not None:
+        ignore_stack = ignore_stack + [rules]
+    sub_sig = getIgnoreSig(sig, rules)
+    if cached is not None and cached.sub_sig == sub_sig:
+        file_names, sub_dir_names = cached.file_names, cached.sub_dir_names
+    else:
+        listed = listDir(dir, rel_dir, ignore_stack)
+        if listed is None:
+            return
+        file_names, sub_dir_names = listed
+    if cache is not None:
+        cache.store(rel_dir, UntrackedCacheEntry(
+            dir_mtime, sig, sub_sig, rules is not None, file_names,
+            sub_dir_names))
+    for name in file_names:
+        paths.append(path.join(dir, name))
+    for name in sub_dir_names:
+        walkDir(path.join(dir, name), rel_dir + '/' + name if rel_dir
+                else name, ignore_stack, paths, cache, sub_sig)
+
+
+# Check if a dir or one of the dirs above it is ignored
+def isDirIgnored(rel_dir, ignore_stack):
+    '''
+    input: rel_dir: dir relative to the lgit parent; ignore_stack:
+           IgnoreRules of the dirs above it, from getIgnoreStack
+    '''
+    parts = rel_dir.split('/') if rel_dir else []
+    return any(isIgnored('/'.join(parts[:idx]), True, ignore_stack)
+               for idx in range(1, len(parts) + 1))
+
+
+# Get all the paths in a dir recursively, without the ignored ones
+def getDirRecursively(dir, lgit_parent_path, cache=None):
+    rel_dir = getIndexFileName(path.abspath(dir), lgit_parent_path)
+    ignore_stack = getIgnoreStack(dir, lgit_parent_path)
+    # an ignored dir is not walked even when asked for, like gitignore
+    if isDirIgnored(rel_dir, ignore_stack):
+        return []
+    sig = ''
+    for rules in ignore_stack:
+        sig = getIgnoreSig(sig, rules)
+    paths = []
+    walkDir(dir, rel_dir, ignore_stack, paths, cache, sig)
+    return paths
+
+
+'''_____________________UNTRACKED CACHE_____________________________'''
+
+
+# What the walk found in a dir: its mtime, the sig of the ignore rules
+# above it and with its own ignore file, and its files and sub dirs that
+# are not ignored
+class UntrackedCacheEntry:
+    __slots__ = ('mtime_ns', 'sig', 'sub_sig', 'has_ignore_file',
+                 'file_names', 'sub_dir_names')
+
+    def __init__(self, mtime_ns, sig, sub_sig, has_ignore_file, file_names,
+                 sub_dir_names):
+        self.mtime_ns = mtime_ns
+        self.sig = sig
+        self.sub_sig = sub_sig
+        self.has_ignore_file = has_ignore_file
+        self.file_names = file_names
+        self.sub_dir_names = sub_dir_names
+
+    def toList(self):
+        return [self.mtime_ns, self.sig, self.sub_sig, self.has_ignore_file,
+                self.file_names, self.sub_dir_names]
+
+
+# The listing of the dirs of the working tree saved in .lgit, so status
+# lists again only the dirs whose mtime changed since the last run.
+# Relies on the mtime of a dir changing when an entry is added or removed.
+class UntrackedCache:
+    VERSION = 1
+
+    def __init__(self, lgit_path):
+        self.cache_path = path.join(lgit_path, 'untracked-cache')
+        self.dirs = {}
+        self.new_dirs = {}
+        self.dirty = False
+        # mtime of the cache file when loaded, for the racy check
+        self.mtime_ns = 0
+        # fsmonitor token of the time the listing was saved
+        self.token = None
+        self.saved_token = None
+        # FsmonitorChanges since that token, if the fsmonitor knows them
+        self.changes = None
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.mtime_ns = fstat(f.fileno()).st_mtime_ns
+                content = json.load(f)
+            if content.get('version') == self.VERSION:
+                self.dirs = {rel_dir: UntrackedCacheEntry(*entry)
+                             for rel_dir, entry in content['dirs'].items()}
+                self.token = content.get('fsmonitor_token')
+                self.saved_token = self.token
+        except (FileNotFoundError, ValueError, TypeError, KeyError):
+            self.dirs = {}
+
+    def useFsmonitor(self, changes):
+        '''
+        input: FsmonitorChanges since the token the cache was saved with
+        '''
+        if changes.paths is not None and changes.since == self.token:
+            self.changes = changes
+
+    def lookupUnchanged(self, rel_dir, sig):
+        '''
+        output: UntrackedCacheEntry of the dir if the fsmonitor saw nothing
+                change in it, None if unknown
+        '''
+        if self.changes is None or self.changes.isDirChanged(rel_dir):
+            return None
+        entry = self.dirs.get(rel_dir)
+        if entry is None or entry.sig != sig:
+            return None
+        return entry
+
+    def lookup(self, rel_dir, dir_mtime, sig):
+        '''
+        output: UntrackedCacheEntry of the dir if it can be trusted, None if
+                the dir has to be listed again
+        '''
+        entry = self.dirs.get(rel_dir)
+        if entry is None or entry.mtime_ns != dir_mtime or entry.sig != sig:
+            return None
+        # A dir changed in the same second the cache was written may have
+        # changed again without its mtime changing
+        if dir_mtime // NS_PER_SEC >= self.mtime_ns // NS_PER_SEC:
+            self.dirty = True
+            return None
+        return entry
+
+    def store(self, rel_dir, entry):
+        old_entry = self.dirs.get(rel_dir)
+        if old_entry is None or old_entry.toList() != entry.toList():
+            self.dirty = True
+        self.new_dirs[rel_dir] = entry
+
+    def flush(self):
+        '''
+        output: write the dirs seen by this walk if anything changed,
+                dirs that were not walked again are dropped
+        '''
+        if (not self.dirty and len(self.new_dirs) == len(self.dirs) and
+                self.token == self.saved_token):
+            return
+        content = {'version': self.VERSION, 'fsmonitor_token': self.token,
+                   'dirs': {rel_dir: entry.toList()
+                            for rel_dir, entry in self.new_dirs.items()}}
+        fd, tmp_path = mkstemp(prefix='tmp_untracked_',
+                               dir=path.dirname(self.cache_path))
+        with fdopen(fd, 'w') as f:
+            json.dump(content, f, separators=(',', ':'))
+        rename(tmp_path, self.cache_path)
+
+
+# lgit add dir
+# Keep only the files to add that may have changed since the last status
+def filterWithFsmonitor(files, changes, repo):
+    index = repo.getIndex()
+    kept = []
+    for file in files:
+        file_name = getIndexFileName(path.abspath(file), repo.root)
+        entry = index.get(file_name)
+        # untracked, changed since the last status, or modified then
+        if (entry is None or changes.isChanged(file_name) or
+                entry.isUnstaged()):
+            kept.append(file)
+    return kept
+
+
+def addGitDir(dir, repo, jobs=1):
+    rel_dir = getIndexFileName(path.abspath(dir), repo.root)
+    if isDirIgnored(rel_dir, getIgnoreStack(dir, repo.root)):
+        print('The following paths are ignored by one of your {} files:'
+              .format(IGNORE_FILE))
+        print(dir)
+        return
+    repo.getIndex(write=True)
+    changes = queryFsmonitor(repo)
+    if changes is not None and changes.paths is not None:
+        # the cache is only read, the listing is saved by status
+        cache = UntrackedCache(repo.lgit_path)
+        cache.useFsmonitor(changes)
+        files = getDirRecursively(dir, repo.root, cache)
+        files = filterWithFsmonitor(files, changes, repo)
+    else:
+        files = getDirRecursively(dir, repo.root)
+    addGitFiles(files, repo, jobs)
+
+
+def addGitGlob(pattern, repo, jobs=1):
+    '''
+    input: pattern: glob of the files to add, relative to the current dir
+    output: add the files it matches, only the dir before its first glob
+            character is walked
+    '''
+    specs = getPathspecs([pattern], repo.root)
+    if specs is None:
+        return
+    spec = specs[0]
+    prefix = getPathspecPrefix(spec)
+    dir = path.join(repo.root, path.dirname(prefix))
+    files = [file for file in getDirRecursively(dir, repo.root)
+             if fnmatchcase(getIndexFileName(path.abspath(file), repo.root),
+                            spec)]
+    if not files:
+        print("fatal: pathspec '{}' did not match any files".format(pattern))
+        return
+    addGitFiles(files, repo, jobs)
+
+
+def addGitFiles(files, repo, jobs=1):
+    '''
+    Workers hash and store the files concurrently, their results are fed
+    back in walk order into the index, so the result is the same as adding
+    the files one at a time
+    '''
+    repo.getIndex(write=True)
+    if jobs is None or jobs <= 1 or len(files) <= 1:
+        for file in files:
+            addGitFile(file, repo)
+        return
+    index = repo.getIndex()
+    level = repo.getCompressionLevel()
+    chunk_threshold = repo.getChunkThreshold()
+    file_names = [getIndexFileName(path.abspath(file), repo.root)
+                  for file in files]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(hashAndStoreFile, files, file_names,
+                               [repo.lgit_path] * len(files),
+                               [index] * len(files), [level] * len(files),
+                               [chunk_threshold] * len(files))
+        for file_name, (file_stat, file_hash) in zip(file_names, results):
+            updateIndexWithAdd(file_name, file_stat, file_hash, index)
+
+
+# Git commit functions
+# Get timestamp of the current time.
+def getTimeStampNow(mcr_sec=False):
+    if mcr_sec:
+        return datetime.now().strftime('%Y%m%d%H%M%S.%f')
+    else:
+        return datetime.now().strftime('%Y%m%d%H%M%S')
+
+
+# Update the commits dir when lgit commit
+def updateCommits(commits_path, file_name, author_name, message):
+    now_time = getTimeStampNow()
+    content = '\n'.join([author_name, now_time, '', message, ''])
+    file_path = path.join(commits_path, file_name)
+    writeFileContent(file_path, content)
+
+
+# Update the snapshots and index when lgit commit
+def updateSnapshotsAndIndex(snapshots_path, file_name, index):
+    snapshots_file_path = path.join(snapshots_path, file_name)
+    snapshots_content = []
+    for entry in index:
+        if entry.isStaged():
+            entry.commit_hash = entry.add_hash
+            index.setEntry(entry)
+            snapshots_content.append(' '.join([entry.commit_hash,
+                                               entry.path]) + '\n')
+    if snapshots_content:
+        writeFileContent(snapshots_file_path, ''.join(snapshots_content))
+    else:
+        print('no changes added to commit')
+    return bool(snapshots_content)
+
+
+# lgit commit
+def commitGit(repo, message):
+    commits_path = path.join(repo.lgit_path, 'commits')
+    snapshots_path = path.join(repo.lgit_path, 'snapshots')
+    author_name = repo.getConfig()['author']
+    file_name = getTimeStampNow(mcr_sec=True)
+    index = repo.getIndex(write=True)
+    if updateSnapshotsAndIndex(snapshots_path, file_name, index):
+        updateCommits(commits_path, file_name, author_name, message)
+        level = repo.getCompressionLevel()
+        tree_hash = storeTree(repo.lgit_path, index, level)
+        parent_hash = readHead(repo.lgit_path)
+        commit_hash = storeCommit(repo.lgit_path, tree_hash, parent_hash,
+                                  author_name, file_name, message, level)
+        writeHead(repo.lgit_path, commit_hash)
+        appendCommitGraph(repo.lgit_path, file_name, commit_hash, parent_hash)
+
+
+'''_____________________GIT OBJECTS_________________________________'''
+
+
+# A tree object lists a dir sorted by name, a line per entry:
+# 'blob <SHA1> <name>' for a file, 'tree <SHA1> <name>' for a sub dir.
+# A commit object is 'tree <SHA1>', 'parent <SHA1>' for all but the first
+# commit, 'author <name>', 'date <timestamp>', an empty line, the message.
+
+
+def storeTree(lgit_path, index, level=0):
+    '''
+    input: index with all its entries committed
+    output: SHA1 of the root tree of the committed files, trees are written
+            per dir, so an unchanged dir is the same object as before and
+            is not written again
+    '''
+    root = {}
+    for entry in index:
+        if entry.commit_hash is None:
+            continue
+        *dirs, file_name = entry.path.split('/')
+        node = root
+        for dir_name in dirs:
+            node = node.setdefault(dir_name, {})
+        node[file_name] = entry.commit_hash
+    return storeTreeNode(lgit_path, root, level)
+
+
+def storeTreeNode(lgit_path, node, level):
+    lines = []
+    for name in sorted(node):
+        if isinstance(node[name], dict):
+            tree_hash = storeTreeNode(lgit_path, node[name], level)
+            lines.append('tree {} {}\n'.format(tree_hash, name))
+        else:
+            lines.append('blob {} {}\n'.format(node[name], name))
+    data = ''.join(lines).encode(errors='surrogateescape')
+    return storeObjectData(lgit_path, data, level)
+
+
+def readTree(lgit_path, tree_hash):
+    '''
+    output: list of (kind, SHA1, name) of a tree object
+    '''
+    data = readObject(lgit_path, tree_hash).decode(errors='surrogateescape')
+    return [tuple(line.split(' ', 2)) for line in data.splitlines()]
+
+
+def getTreeFiles(lgit_path, tree_hash, prefix=''):
+    '''
+    output: {path: SHA1} of all files under a tree
+    '''
+    files = {}
+    for kind, file_hash, name in readTree(lgit_path, tree_hash):
+        if kind == 'tree':
+            files.update(getTreeFiles(lgit_path, file_hash,
+                                      prefix + name + '/'))
+        else:
+            files[prefix + name] = file_hash
+    return files
+
+
+def storeCommit(lgit_path, tree_hash, parent_hash, author_name, date,
+                message, level=0):
+    lines = ['tree ' + tree_hash]
+    if parent_hash is not None:
+        lines.append('parent ' + parent_hash)
+    lines.extend(['author ' + author_name, 'date ' + date, '', message])
+    data = ('\n'.join(lines) + '\n').encode(errors='surrogateescape')
+    return storeObjectData(lgit_path, data, level)
+
+
+def readCommit(lgit_path, commit_hash):
+    '''
+    output: dict of the fields of a commit object, with its 'message'
+    '''
+    data = readObject(lgit_path, commit_hash).decode(errors='surrogateescape')
+    header, _, message = data.partition('\n\n')
+    commit = {'parent': None, 'message': message.rstrip('\n')}
+    for line in header.splitlines():
+        key, _, value = line.partition(' ')
+        commit[key] = value
+    return commit
+
+
+def getCommitFiles(lgit_path, commit_hash):
+    '''
+    output: {path: SHA1} of the full tree of a commit
+    '''
+    return getTreeFiles(lgit_path, readCommit(lgit_path,
+                                              commit_hash)['tree'])
+
+
+# Get the SHA1 of the last commit, None if there is no commit object yet
+def readHead(lgit_path):
+    try:
+        with open(path.join(lgit_path, 'HEAD')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def writeHead(lgit_path, commit_hash):
+    with LockFile(path.join(lgit_path, 'HEAD')).acquire() as lock:
+        lock.write((commit_hash + '\n').encode())
+        lock.commit()
+
+
+'''_____________________GIT PACK_________________________________'''
+
+
+# A pack is one file of zlib streams of objects, its .idx is a header,
+# a fanout table of counts by first byte of SHA1, then records sorted by
+# SHA1: (raw SHA1, offset in pack, compressed length, kind of object)
+PACK_HEADER = b'LPACK\x00\x00\x01'
+PACK_IDX_MAGIC = b'LPIX'
+PACK_IDX_VERSION = 1
+PACK_IDX_HEADER = Struct('>4sII')
+PACK_IDX_FANOUT = Struct('>256I')
+PACK_IDX_RECORD = Struct('>20sQQI')
+OBJECT_KIND_BLOB = 0
+OBJECT_KIND_DELTA = 1
+OBJECT_KIND_CHUNKS = 2
+
+# Pack indexes opened by this process, by path of their pack dir
+PACK_INDEXES = {}
+
+
+# The .idx of a pack, memory-mapped and searched with binary search
+class PackIndex:
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+        with open(idx_path, 'rb') as f:
+            self.mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        magic, version, self.count = PACK_IDX_HEADER.unpack_from(self.mm)
+        if magic != PACK_IDX_MAGIC or version != PACK_IDX_VERSION:
+            raise ValueError('bad pack index: ' + idx_path)
+        self.fanout = PACK_IDX_FANOUT.unpack_from(self.mm,
+                                                  PACK_IDX_HEADER.size)
+        self.records_offset = PACK_IDX_HEADER.size + PACK_IDX_FANOUT.size
+
+    def getRecord(self, pos):
+        return PACK_IDX_RECORD.unpack_from(
+            self.mm, self.records_offset + pos * PACK_IDX_RECORD.size)
+
+    def find(self, file_hash):
+        '''
+        input: SHA1 of an object
+        output: (offset, length, kind) of the object in the pack or None
+        '''
+        key = bytes.fromhex(file_hash)
+        lo = self.fanout[key[0] - 1] if key[0] else 0
+        hi = self.fanout[key[0]]
+        mm = self.mm
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.records_offset + mid * PACK_IDX_RECORD.size
+            mid_key = mm[start:start + 20]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self.getRecord(mid)[1:]
+        return None
+
+    def __iter__(self):
+        for pos in range(self.count):
+            raw_hash, offset, length, kind = self.getRecord(pos)
+            yield raw_hash.hex(), offset, length, kind
+
+    def close(self):
+        self.mm.close()
+
+
+# Get the pack dir of the lgit
+def getPackDir(lgit_path):
+    return path.join(lgit_path, 'objects', 'pack')
+
+
+def getPackIndexes(lgit_path, rescan=False):
+    '''
+    input: rescan: look again for packs written by other processes
+    output: list of PackIndex of all packs of the lgit
+    '''
+    pack_dir = getPackDir(lgit_path)
+    packs = PACK_INDEXES.get(pack_dir)
+    if packs is not None and not rescan:
+        return packs
+    try:
+        idx_names = sorted(name for name in listdir(pack_dir)
+                           if name.endswith('.idx'))
+    except FileNotFoundError:
+        idx_names = []
+    opened = {pack.idx_path: pack for pack in packs or []}
+    packs = []
+    for idx_name in idx_names:
+        idx_path = path.join(pack_dir, idx_name)
+        if idx_path in opened:
+            packs.append(opened.pop(idx_path))
+        else:
+            try:
+                packs.append(PackIndex(idx_path))
+            except (FileNotFoundError, ValueError):
+                continue
+    for pack in opened.values():
+        pack.close()
+    PACK_INDEXES[pack_dir] = packs
+    return packs
+
+
+def findPackedObject(lgit_path, file_hash, rescan=False):
+    '''
+    input: SHA1 of an object; rescan: look for new packs if it is not found
+    output: (PackIndex, offset, length, kind) of the object or None
+    '''
+    for pack in getPackIndexes(lgit_path):
+        found = pack.find(file_hash)
+        if found is not None:
+            return (pack,) + found
+    if rescan:
+        # another process may have repacked since the packs were opened
+        for pack in getPackIndexes(lgit_path, rescan=True):
+            found = pack.find(file_hash)
+            if found is not None:
+                return (pack,) + found
+    return None
+
+
+# Get the loose objects as {SHA1: path of the object file}
+def getLooseObjects(lgit_path):
+    objects_path = path.join(lgit_path, 'objects')
+    loose_objects = {}
+    for dir_name in listdir(objects_path):
+        dir_path = path.join(objects_path, dir_name)
+        if len(dir_name) != 2 or not path.isdir(dir_path):
+            continue
+        for file_name in listdir(dir_path):
+            file_hash = dir_name + file_name[:38]
+            if len(file_hash) == 40 and file_name[38:] in (
+                    '', COMPRESSED_SUFFIX, DELTA_SUFFIX, CHUNKS_SUFFIX):
+                loose_objects.setdefault(file_hash,
+                                         path.join(dir_path, file_name))
+    return loose_objects
+
+
+def getLooseKind(object_path):
+    if object_path.endswith(DELTA_SUFFIX):
+        return OBJECT_KIND_DELTA
+    if object_path.endswith(CHUNKS_SUFFIX):
+        return OBJECT_KIND_CHUNKS
+    return OBJECT_KIND_BLOB
+
+
+# Write the compressed data of a loose object to the pack
+def writeLooseToPack(dst, object_path, level):
+    with open(object_path, 'rb') as src:
+        if object_path.endswith((COMPRESSED_SUFFIX, DELTA_SUFFIX,
+                                 CHUNKS_SUFFIX)):
+            # already a zlib stream, copied as it is
+            compressor = None
+        else:
+            compressor = zlib.compressobj(level)
+        for data in readFileChunks(src):
+            if compressor is not None:
+                data = compressor.compress(data)
+            dst.write(data)
+        if compressor is not None:
+            dst.write(compressor.flush())
+
+
+# Write the compressed data of an object of another pack to the pack
+def writePackedToPack(dst, pack, offset, length):
+    with open(pack.pack_path, 'rb') as src:
+        src.seek(offset)
+        for data in readFileChunks(src, length=length):
+            dst.write(data)
+
+
+def writePackIndex(idx_path, records):
+    '''
+    input: records: list of (raw SHA1, offset, length, kind) sorted by SHA1
+    output: write the .idx of a pack
+    '''
+    fanout = [0] * 256
+    for record in records:
+        fanout[record[0][0]] += 1
+    for idx in range(1, 256):
+        fanout[idx] += fanout[idx - 1]
+    fd, tmp_path = mkstemp(prefix='tmp_idx_', dir=path.dirname(idx_path))
+    with fdopen(fd, 'wb') as f:
+        f.write(PACK_IDX_HEADER.pack(PACK_IDX_MAGIC, PACK_IDX_VERSION,
+                                     len(records)))
+        f.write(PACK_IDX_FANOUT.pack(*fanout))
+        for record in records:
+            f.write(PACK_IDX_RECORD.pack(*record))
+        fchmod(f.fileno(), 0o444)
+    rename(tmp_path, idx_path)
+
+
+# Remove the loose objects and the packs that were packed again
+def removePacked(lgit_path, loose_objects, old_packs):
+    for object_path in loose_objects.values():
+        try:
+            unlink(object_path)
+        except FileNotFoundError:
+            pass
+    for dir_path in set(path.dirname(p) for p in loose_objects.values()):
+        try:
+            rmdir(dir_path)
+        except OSError:  # not empty
+            pass
+    for pack in old_packs:
+        pack.close()
+        for pack_file in (pack.idx_path, pack.pack_path):
+            try:
+                unlink(pack_file)
+            except FileNotFoundError:
+                pass
+    PACK_INDEXES.pop(getPackDir(lgit_path), None)
+
+
+# lgit repack / lgit gc
+def repackGit(repo, prune=False):
+    '''
+    input: prune: leave out the objects that are not reachable
+    output: put all loose objects and packs into one pack file with its
+            sorted .idx, then remove them
+    '''
+    lgit_path = repo.lgit_path
+    pack_dir = getPackDir(lgit_path)
+    makedirs(pack_dir, exist_ok=True)
+    level = repo.getCompressionLevel() or zlib.Z_DEFAULT_COMPRESSION
+    reachable = None
+    if prune:
+        # no add can write objects the index does not show yet meanwhile
+        repo.getIndex(write=True)
+        reachable = getReachableObjects(repo)
+        removeStaleTempFiles(lgit_path)
+    loose_objects = getLooseObjects(lgit_path)
+    old_packs = getPackIndexes(lgit_path, rescan=True)
+    packed = {}
+    for pack in old_packs:
+        for file_hash, offset, length, kind in pack:
+            packed.setdefault(file_hash, (pack, offset, length, kind))
+    file_hashes = sorted(set(loose_objects) | set(packed))
+    pruned = 0
+    if reachable is not None:
+        pruned = len(file_hashes)
+        file_hashes = [file_hash for file_hash in file_hashes
+                       if file_hash in reachable]
+        pruned -= len(file_hashes)
+    if not pruned and not loose_objects and len(old_packs) <= 1:
+        print('Nothing new to pack.')
+        return
+    if not file_hashes:
+        removePacked(lgit_path, loose_objects, old_packs)
+        print('Pruned {} objects'.format(pruned))
+        return
+    pack_name = 'pack-' + sha1(''.join(file_hashes).encode()).hexdigest()
+    pack_path = path.join(pack_dir, pack_name + '.pack')
+    records = []
+    fd, tmp_path = mkstemp(prefix='tmp_pack_', dir=pack_dir)
+    with fdopen(fd, 'wb') as dst:
+        dst.write(PACK_HEADER)
+        for file_hash in file_hashes:
+            offset = dst.tell()
+            if file_hash in loose_objects:
+                object_path = loose_objects[file_hash]
+                writeLooseToPack(dst, object_path, level)
+                kind = getLooseKind(object_path)
+            else:
+                pack, pack_offset, length, kind = packed[file_hash]
+                writePackedToPack(dst, pack, pack_offset, length)
+            records.append((bytes.fromhex(file_hash), offset,
+                            dst.tell() - offset, kind))
+        fchmod(dst.fileno(), 0o444)
+    rename(tmp_path, pack_path)
+    # the .idx is written last, a pack is not used before it has one
+    writePackIndex(pack_path[:-len('.pack')] + '.idx', records)
+    # the pack is on disk before the objects it replaces are removed
+    markWritten(pack_path)
+    markWritten(pack_path[:-len('.pack')] + '.idx')
+    syncWritten(pack_dir)
+    removePacked(lgit_path, loose_objects,
+                 [pack for pack in old_packs if pack.pack_path != pack_path])
+    print('Packed {} objects into {}'.format(len(records), pack_name))
+    if reachable is not None:
+        print('Pruned {} objects'.format(pruned))
+
+
+'''_____________________GIT FSCK_________________________________'''
+
+
+# Seconds after which a temp file in objects is left from a crash
+TEMP_FILE_MAX_AGE = 3600
+
+
+def isChunkedObject(lgit_path, file_hash):
+    if path.isfile(getObjectPath(lgit_path, file_hash) + CHUNKS_SUFFIX):
+        return True
+    packed = findPackedObject(lgit_path, file_hash)
+    return packed is not None and packed[3] == OBJECT_KIND_CHUNKS
+
+
+# Get the SHA1 of all commits of the commit-graph and of HEAD
+def getAllCommits(lgit_path):
+    commits = set()
+    head = readHead(lgit_path)
+    if head is not None:
+        commits.add(head)
+    f = openCommitGraph(lgit_path)
+    if f is None:
+        return commits
+    with f:
+        for pos in range(getGraphCount(f)):
+            commit_hash = readGraphRecord(f, pos)[1]
+            if commit_hash is not None:
+                commits.add(commit_hash)
+    return commits
+
+
+def getReachableObjects(repo, missing=None):
+    '''
+    input: missing: list the SHA1 of objects referred to but not stored are
+           added to
+    output: set of SHA1 of the objects reachable from the index, the
+            snapshots and the commits, with the bases of their deltas and
+            their chunks
+    '''
+    lgit_path = repo.lgit_path
+    # (kind, SHA1) still to visit
+    pending = []
+    for entry in repo.getIndex():
+        pending.append(('blob', entry.add_hash))
+        pending.append(('blob', entry.commit_hash))
+    snapshots_path = path.join(lgit_path, 'snapshots')
+    for file_name in listdir(snapshots_path):
+        for line in getFileContent(path.join(snapshots_path, file_name)):
+            if line.strip():
+                pending.append(('blob', line.split(' ', 1)[0]))
+    pending.extend(('commit', commit_hash)
+                   for commit_hash in getAllCommits(lgit_path))
+    reachable = set()
+    while pending:
+        kind, file_hash = pending.pop()
+        if file_hash is None or file_hash in reachable:
+            continue
+        if not hasObject(lgit_path, file_hash):
+            if missing is not None:
+                missing.append((kind, file_hash))
+            continue
+        reachable.add(file_hash)
+        if kind == 'commit':
+            commit = readCommit(lgit_path, file_hash)
+            pending.append(('tree', commit.get('tree')))
+            pending.append(('commit', commit['parent']))
+        elif kind == 'tree':
+            pending.extend((entry_kind, entry_hash) for entry_kind,
+                           entry_hash, _ in readTree(lgit_path, file_hash))
+        elif isDeltaObject(lgit_path, file_hash):
+            pending.append(('blob', parseDeltaHeader(readDeltaPayload(
+                lgit_path, file_hash))[0]))
+        elif isChunkedObject(lgit_path, file_hash):
+            pending.extend(('blob', chunk_hash) for chunk_hash, _
+                           in readChunkList(lgit_path, file_hash))
+    return reachable
+
+
+# Remove the temp files a crashed command left in objects
+def removeStaleTempFiles(lgit_path):
+    now = datetime.now().timestamp()
+    for dir_path in (path.join(lgit_path, 'objects'), getPackDir(lgit_path)):
+        try:
+            file_names = listdir(dir_path)
+        except FileNotFoundError:
+            continue
+        for file_name in file_names:
+            file_path = path.join(dir_path, file_name)
+            try:
+                if (file_name.startswith('tmp_') and
+                        now - stat(file_path).st_mtime > TEMP_FILE_MAX_AGE):
+                    unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+
+# Get the SHA1 of all stored objects, loose and packed
+def getAllObjects(lgit_path):
+    file_hashes = set(getLooseObjects(lgit_path))
+    for pack in getPackIndexes(lgit_path, rescan=True):
+        file_hashes.update(file_hash for file_hash, _, _, _ in pack)
+    return sorted(file_hashes)
+
+
+def verifyObject(lgit_path, file_hash):
+    '''
+    output: None if the content of the object has its SHA1, else the error
+    '''
+    SHA1 = sha1()
+    try:
+        for data in readObjectChunks(lgit_path, file_hash):
+            SHA1.update(data)
+    except (OSError, ValueError, zlib.error) as e:
+        return 'error in object {}: {}'.format(file_hash, e)
+    if SHA1.hexdigest() != file_hash:
+        return 'hash mismatch {}: content hashes to {}'.format(
+            file_hash, SHA1.hexdigest())
+    return None
+
+
+# Show the progress of a long command on a terminal
+def printProgress(title, done, total):
+    if sys.stderr.isatty():
+        end = '\n' if done == total else ''
+        sys.stderr.write('\r{}: {}% ({}/{}){}'.format(
+            title, done * 100 // max(total, 1), done, total, end))
+        sys.stderr.flush()
+
+
+def fsckGit(repo, fast=False, jobs=1):
+    '''
+    Check that the objects the index and commits refer to are there, then
+    that every stored object hashes to its name, in worker processes
+    '''
+    lgit_path = repo.lgit_path
+    errors = []
+    missing = []
+    getReachableObjects(repo, missing)
+    for kind, file_hash in missing:
+        errors.append('missing {} {}'.format(kind, file_hash))
+        print(errors[-1])
+    if errors and fast:
+        return False
+    file_hashes = getAllObjects(lgit_path)
+    done = 0
+    with ProcessPoolExecutor(max_workers=max(jobs or 1, 1)) as executor:
+        futures = [executor.submit(verifyObject, lgit_path, file_hash)
+                   for file_hash in file_hashes]
+        for future in as_completed(futures):
+            done += 1
+            printProgress('Checking objects', done, len(futures))
+            error = future.result()
+            if error is None:
+                continue
+            errors.append(error)
+            if sys.stderr.isatty():
+                sys.stderr.write('\n')
+            print(error)
+            if fast:
+                executor.shutdown(cancel_futures=True)
+                break
+    if not errors:
+        print('Checked {} objects, no errors'.format(len(file_hashes)))
+    return not errors
+
+
+'''___________________________GIT STATUS_________________________________'''
+
+
+def updateWithStatus(entry, file_path, index):
+    '''
+    Refresh current hash of the entry from the working tree, the file is
+    only read again when its stat data changed since it was last hashed
+    '''
+    try:
+        file_stat = stat(file_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    # a dir in place of the file is left to show as a deleted file
+    if not S_ISREG(file_stat.st_mode):
+        return
+    if not index.isUpToDate(entry, file_stat):
+        file_hash = getSha1(file_path)
+        if file_hash is None:
+            # removed since the stat
+            return
+        entry.current_hash = file_hash
+        index.refreshStat(entry, file_stat)
+
+
+def getIndexFileName(file_path, lgit_parent_path):
+    '''
+    input: file_path: abspath to the file
+    output: file_name saved in index file, '' for the root itself
+    '''
+    file_name = path.relpath(file_path, lgit_parent_path)
+    return '' if file_name == '.' else file_name
+
+
+def getTrackAndUntrack(file_paths, tracked_names, dir_path):
+    '''
+    input: file_paths: paths under dir_path; tracked_names: set of paths
+           saved in the index, relative to dir_path
+    output: (tracked, untracked) file_paths, classified in one pass
+    '''
+    prefix_len = len(dir_path) + 1
+    untracked_files = []
+    tracked_files = []
+    for file_path in file_paths:
+        if file_path[prefix_len:] in tracked_names:
+            tracked_files.append(file_path)
+        else:
+            untracked_files.append(file_path)
+    return tracked_files, untracked_files
+
+
+def getStagedAndUnstaged(index):
+    staged_files = []
+    unstaged_files = []
+    for entry in index:
+        if entry.isStaged():
+            staged_files.append(entry.path)
+        if entry.isUnstaged():
+            unstaged_files.append(entry.path)
+    return staged_files, unstaged_files
+
+
+def isCommitNoChange(index):
+    for entry in index:
+        if entry.isStaged():
+            return False
+    return True
+
+
+def printStaged(staged_files, git_path):
+    print("Changes to be committed:")
+    print("  (use \"./lgit.py reset HEAD ...\" to unstage)")
+    print()
+    for file_path in staged_files:
+        abspath = path.join(git_path, file_path)
+        rel_path = path.relpath(abspath)
+        print('\tmodified:  %s' % rel_path)
+    print()
+
+
+def printUnstaged(unstaged_files, git_path):
+    print("Changes not staged for commit:")
+    print("  (use \"./lgit.py add ...\" to update what will be committed)")
+    print("  (use \"./lgit.py checkout -- ...\" to discard changes\
+ in working directory")
+    print()
+    for file_path in unstaged_files:
+        abspath = path.join(git_path, file_path)
+        rel_path = path.relpath(abspath)
+        print('\tmodified:  %s' % rel_path)
+    print()
+
+
+def printUntracked(untracked_files):
+    print("Untracked files:")
+    print("  (use \"./lgit.py add <file>...\" to include\
+ in what will be committed)")
+    print()
+    for file_path in untracked_files:
+        rel_path = path.relpath(file_path)
+        print('\t' + rel_path)
+    print()
+
+
+def printHeader(lgit_path):
+    print('On branch master\n')
+    if listdir(path.join(lgit_path, 'commits')):
+        print("Your branch is up-to-date with 'origin/master'.\n")
+    else:
+        print("No commits yet\n")
+
+
+def printTailer(lgit_path, index):
+    if not (listdir(path.join(lgit_path, 'commits')) and
+            listdir(path.join(lgit_path, 'objects'))):
+        print("nothing added to commit but untracked files present\
+ (use \"./lgit.py add\" to track)")
+    elif isCommitNoChange(index):
+        print("no changes added to commit (use \"./lgit.py add and/or\
+ \"./lgit.py commit -a\")")
+
+
+def showStatus(repo, staged_files, unstaged_files, untracked_files):
+    printHeader(repo.lgit_path)
+    if staged_files:
+        printStaged(staged_files, repo.root)
+    if unstaged_files:
+        printUnstaged(unstaged_files, repo.root)
+    if untracked_files:
+        printUntracked(untracked_files)
+    printTailer(repo.lgit_path, repo.getIndex())
+
+
+# Get the status as 'XY path' lines for scripts, like git --porcelain
+def getPorcelainLines(index, untracked_files, git_path):
+    lines = []
+    for entry in index:
+        staged = ' '
+        if entry.isStaged():
+            staged = 'A' if entry.commit_hash is None else 'M'
+        unstaged = 'M' if entry.isUnstaged() else ' '
+        if staged != ' ' or unstaged != ' ':
+            lines.append(staged + unstaged + ' ' + entry.path)
+    prefix_len = len(git_path) + 1
+    for file_path in sorted(untracked_files):
+        lines.append('?? ' + file_path[prefix_len:])
+    return lines
+
+
+def showPorcelain(index, untracked_files, git_path):
+    for line in getPorcelainLines(index, untracked_files, git_path):
+        print(line)
+
+
+def getStatus(repo, untracked_cache=True):
+    '''
+    output: untracked files, the entries of the index are updated with the
+            state of their file
+    '''
+    git_path = repo.root
+    index = repo.getIndex()
+    # Paths changed since the last status, if a fsmonitor is running
+    changes = queryFsmonitor(repo)
+    # Tracked files are checked from the index, one stat each, or only the
+    # ones the fsmonitor saw change
+    entries = index.getEntries()
+    for entry in entries:
+        if changes is None or changes.isChanged(entry.path):
+            updateWithStatus(entry, path.join(git_path, entry.path), index)
+    # The walk is only needed to find untracked files, it can be turned
+    # off on file systems where the mtime of dirs can not be trusted
+    cache = None
+    if untracked_cache and repo.getConfig().get('untracked_cache') != 'false':
+        cache = UntrackedCache(repo.lgit_path)
+        if changes is not None:
+            cache.useFsmonitor(changes)
+            cache.token = changes.token
+    file_paths = getDirRecursively(git_path, git_path, cache)
+    if cache is not None:
+        cache.flush()
+    # everything changed before the new token has been checked now, but it
+    # is only saved with the entries refreshed by this check, or the next
+    # status would not look at them again
+    if changes is not None and repo.flush():
+        saveFsmonitorToken(repo.lgit_path, changes.token)
+    tracked_names = set(entry.path for entry in entries)
+    _, untracked_files = getTrackAndUntrack(file_paths, tracked_names,
+                                            git_path)
+    return untracked_files
+
+
+def checkGitStt(repo, porcelain=False, untracked_cache=True):
+    untracked_files = getStatus(repo, untracked_cache)
+    index = repo.getIndex()
+    if porcelain:
+        showPorcelain(index, untracked_files, repo.root)
+        return
+    staged_files, unstaged_files = getStagedAndUnstaged(index)
+    showStatus(repo, staged_files, unstaged_files, untracked_files)
+
+
+# Get the dirs under root that hold a .lgit, the .lgit dirs themselves and
+# symlinks are not entered
+def findRepositories(root):
+    roots = []
+    stack = [path.abspath(root)]
+    while stack:
+        dir = stack.pop()
+        try:
+            entries = list(scandir(dir))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            if entry.name == '.lgit':
+                roots.append(dir)
+            else:
+                stack.append(entry.path)
+    return sorted(roots)
+
+
+def getRepoStatus(root, untracked_cache=True):
+    '''
+    input: root: working tree of a repository
+    output: (porcelain lines, None), or (None, error message) so a broken
+            repository does not stop the others
+    '''
+    repo = Repository(root)
+    try:
+        untracked_files = getStatus(repo, untracked_cache)
+        lines = getPorcelainLines(repo.getIndex(), untracked_files, root)
+        # keep the refreshed stat data, like a status in the repository
+        repo.flush()
+        return lines, None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+    finally:
+        repo.rollback()
+
+
+# Get a one line summary of the porcelain lines of a repository
+def getStatusSummary(lines):
+    if not lines:
+        return 'clean'
+    staged = sum(1 for line in lines if line[0] not in ' ?')
+    modified = sum(1 for line in lines if line[1] == 'M')
+    untracked = sum(1 for line in lines if line.startswith('??'))
+    return '{} staged, {} modified, {} untracked'.format(staged, modified,
+                                                        untracked)
+
+
+def statusAllGit(root, porcelain=False, untracked_cache=True, jobs=1):
+    '''
+    Check every repository under root in worker processes, the results are
+    printed in path order, one line per repository, or with porcelain the
+    lines of every repository with paths relative to the current dir
+    '''
+    roots = findRepositories(root)
+    if not roots:
+        print("fatal: no repository found under '{}'".format(root))
+        return
+    with ProcessPoolExecutor(max_workers=max(jobs or 1, 1)) as executor:
+        results = executor.map(getRepoStatus, roots,
+                               [untracked_cache] * len(roots))
+        for repo_root, (lines, error) in zip(roots, results):
+            rel_root = path.relpath(repo_root)
+            if error is not None:
+                print('fatal: {}: {}'.format(rel_root, error))
+            elif porcelain:
+                for line in lines:
+                    print(line[:3] + path.normpath(path.join(rel_root,
+                                                             line[3:])))
+            else:
+                print('{}: {}'.format(rel_root, getStatusSummary(lines)))
+
+
+'''_____________________FSMONITOR_________________________________'''
+
+
+# inotify(7) constants
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+INOTIFY_EVENT = Struct('iIII')
+# Forget the changed paths and ask for a full scan past this many
+FSMONITOR_MAX_CHANGES = 1000000
+FSMONITOR_TIMEOUT = 2
+
+
+# Get the path of the socket of the fsmonitor of a lgit
+def getFsmonitorSocketPath(lgit_path):
+    socket_path = path.join(lgit_path, 'fsmonitor.sock')
+    # the path of a unix socket is limited to about 100 bytes
+    if len(fsencode(socket_path)) > 100:
+        name = sha1(fsencode(lgit_path)).hexdigest()[:16]
+        socket_path = path.join(gettempdir(), 'lgit-fsmonitor-{}.sock'.format(
+            name))
+    return socket_path
+
+
+# The daemon: watches every dir of the working tree with inotify and
+# answers which paths changed since a token over a unix socket
+class FsMonitor:
+    def __init__(self, repo):
+        self.root = repo.root
+        self.socket_path = getFsmonitorSocketPath(repo.lgit_path)
+        self.libc = ctypes.CDLL(find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # a new daemon id makes the tokens of an older daemon invalid
+        self.daemon_id = uuid4().hex
+        self.seq = 0
+        # tokens before this seq must do a full scan
+        self.full_seq = 1
+        self.watches = {}
+        # changed path relative to root: seq it was seen at
+        self.changes = {}
+        self.running = True
+        self.addWatches('')
+
+    def getToken(self):
+        return '{}:{}'.format(self.daemon_id, self.seq)
+
+    def overflow(self):
+        # changes were lost, every client has to do a full scan
+        self.changes.clear()
+        self.seq += 1
+        self.full_seq = self.seq + 1
+
+    def addWatches(self, rel_dir):
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            if rel_dir == '.lgit' or rel_dir.endswith('/.lgit'):
+                continue
+            dir_path = path.join(self.root, rel_dir) if rel_dir else self.root
+            wd = self.libc.inotify_add_watch(self.fd, fsencode(dir_path),
+                                             WATCH_MASK)
+            if wd < 0:
+                if ctypes.get_errno() == errno.ENOSPC:
+                    self.overflow()
+                    return
+                continue
+            self.watches[wd] = rel_dir
+            try:
+                for entry in scandir(dir_path):
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(rel_dir + '/' + entry.name if rel_dir
+                                     else entry.name)
+            except OSError:
+                continue
+
+    def readEvents(self):
+        '''
+        Read all queued events, the kernel queues them when the change is
+        made, so a query sees every change made before it
+        '''
+        self.seq += 1
+        while True:
+            try:
+                data = read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data,
+                                                                  offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                self.handleEvent(wd, mask, fsdecode(name))
+
+    def handleEvent(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflow()
+            return
+        rel_dir = self.watches.get(wd)
+        if rel_dir is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and rel_dir == '':
+            # the working tree itself is gone
+            self.running = False
+            return
+        rel_path = rel_dir + '/' + name if rel_dir and name else \
+            rel_dir or name
+        if rel_path == '.lgit' or rel_path.startswith('.lgit/'):
+            return
+        self.changes[rel_path] = self.seq
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # watch the new dir, a moved dir keeps its watches which then
+            # point to the new path
+            self.addWatches(rel_path)
+        if len(self.changes) > FSMONITOR_MAX_CHANGES:
+            self.overflow()
+
+    def query(self, token):
+        '''
+        input: token of the last query of the client
+        output: dict with the new token and the paths changed since the
+                token, without paths when the client has to scan everything
+        '''
+        self.readEvents()
+        daemon_id, _, seq = (token or '').partition(':')
+        response = {'token': self.getToken(), 'since': token}
+        if daemon_id == self.daemon_id and seq.isdigit() and \
+                int(seq) >= self.full_seq:
+            seq = int(seq)
+            response['paths'] = [rel_path for rel_path, change_seq
+                                 in self.changes.items() if change_seq > seq]
+        return response
+
+    def handleRequest(self, conn):
+        with conn:
+            conn.settimeout(FSMONITOR_TIMEOUT)
+            request = b''
+            while not request.endswith(b'\n'):
+                data = conn.recv(65536)
+                if not data:
+                    return
+                request += data
+            request = json.loads(request.decode())
+            command = request.get('command')
+            if command == 'query':
+                response = self.query(request.get('token'))
+            elif command == 'stop':
+                self.running = False
+                response = {'stopped': True}
+            else:
+                response = {'pid': getpid(), 'watches': len(self.watches)}
+            conn.sendall(json.dumps(response).encode() + b'\n')
+
+    def serve(self):
+        try:
+            unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        server = socket(AF_UNIX, SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
+        selector = DefaultSelector()
+        selector.register(server, EVENT_READ, 'socket')
+        selector.register(self.fd, EVENT_READ, 'inotify')
+        try:
+            while self.running:
+                for key, _ in selector.select(timeout=60):
+                    if key.data == 'inotify':
+                        self.readEvents()
+                    else:
+                        conn, _ = server.accept()
+                        try:
+                            self.handleRequest(conn)
+                        except (OSError, ValueError):
+                            pass
+        finally:
+            server.close()
+            try:
+                unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+            close(self.fd)
+
+
+# Send a request to the fsmonitor of a lgit, None if it does not answer
+def requestFsmonitor(lgit_path, request):
+    socket_path = getFsmonitorSocketPath(lgit_path)
+    if not path.exists(socket_path):
+        return None
+    try:
+        with socket(AF_UNIX, SOCK_STREAM) as conn:
+            conn.settimeout(FSMONITOR_TIMEOUT)
+            conn.connect(socket_path)
+            conn.sendall(json.dumps(request).encode() + b'\n')
+            response = b''
+            while not response.endswith(b'\n'):
+                data = conn.recv(65536)
+                if not data:
+                    return None
+                response += data
+        return json.loads(response.decode())
+    except (OSError, ValueError):
+        return None
+
+
+# Paths changed since the token of the last status, by the fsmonitor
+class FsmonitorChanges:
+    def __init__(self, token, since, paths):
+        self.token = token
+        self.since = since
+        # None when everything has to be checked
+        self.paths = None if paths is None else set(paths)
+        self.parent_dirs = None
+        if paths is not None:
+            self.parent_dirs = set(path.dirname(rel_path)
+                                   for rel_path in paths)
+
+    def isChanged(self, rel_path):
+        '''
+        output: True if the path or a dir above it changed, a moved dir is
+                reported as one path
+        '''
+        if self.paths is None:
+            return True
+        while rel_path:
+            if rel_path in self.paths:
+                return True
+            rel_path = path.dirname(rel_path)
+        return False
+
+    def isDirChanged(self, rel_dir):
+        # True if an entry was added or removed in the dir
+        return rel_dir in self.parent_dirs or self.isChanged(rel_dir)
+
+
+def queryFsmonitor(repo):
+    '''
+    output: FsmonitorChanges since the last status, None if no fsmonitor
+            is running, then the caller has to scan everything
+    '''
+    token_path = path.join(repo.lgit_path, 'fsmonitor-token')
+    try:
+        with open(token_path) as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        token = None
+    response = requestFsmonitor(repo.lgit_path, {'command': 'query',
+                                                 'token': token})
+    if response is None or 'token' not in response:
+        return None
+    return FsmonitorChanges(response['token'], token, response.get('paths'))
+
+
+def saveFsmonitorToken(lgit_path, token):
+    fd, tmp_path = mkstemp(prefix='tmp_token_', dir=lgit_path)
+    with fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    rename(tmp_path, path.join(lgit_path, 'fsmonitor-token'))
+
+
+# Run the fsmonitor in the background, detached from the terminal
+def startFsmonitor(repo):
+    if requestFsmonitor(repo.lgit_path, {'command': 'ping'}) is not None:
+        print('fsmonitor is already running')
+        return
+    pid = fork()
+    if pid:
+        waitpid(pid, 0)
+        socket_path = getFsmonitorSocketPath(repo.lgit_path)
+        for _ in range(50):
+            if requestFsmonitor(repo.lgit_path,
+                                {'command': 'ping'}) is not None:
+                print('fsmonitor started for', repo.root)
+                return
+            sleep(0.1)
+        print('fatal: fsmonitor did not start, see', socket_path)
+        return
+    setsid()
+    if fork():
+        _exit(0)
+    devnull = open(devnull_path, 'r+b')
+    for fd in (0, 1, 2):
+        dup2(devnull.fileno(), fd)
+    try:
+        FsMonitor(repo).serve()
+    finally:
+        _exit(0)
+
+
+def fsmonitorGit(repo, action):
+    if action == 'start':
+        startFsmonitor(repo)
+    elif action == 'run':
+        FsMonitor(repo).serve()
+    elif action == 'stop':
+        if requestFsmonitor(repo.lgit_path, {'command': 'stop'}) is None:
+            print('fsmonitor is not running')
+    else:
+        response = requestFsmonitor(repo.lgit_path, {'command': 'ping'})
+        if response is None:
+            print('fsmonitor is not running')
+        else:
+            print('fsmonitor is running (pid {}), watching {} dirs'.format(
+                response['pid'], response['watches']))
+
+
+'''_____________________GIT CHECKOUT_________________________________'''
+
+
+def resolveCommit(lgit_path, rev):
+    '''
+    input: rev: 'HEAD' or at least 4 first hex digits of a commit SHA1
+    output: SHA1 of the commit, None if there is none or more than one
+    '''
+    if rev == 'HEAD':
+        return readHead(lgit_path)
+    if not re.fullmatch('[0-9a-f]{4,40}', rev):
+        return None
+    f = openCommitGraph(lgit_path)
+    if f is None:
+        rebuildCommitGraph(lgit_path)
+        f = openCommitGraph(lgit_path)
+        if f is None:
+            return None
+    found = set()
+    with f:
+        for pos in range(getGraphCount(f)):
+            commit_hash = readGraphRecord(f, pos)[1]
+            if commit_hash is not None and commit_hash.startswith(rev):
+                found.add(commit_hash)
+    return found.pop() if len(found) == 1 else None
+
+
+# Get the mode new files get from the umask
+def getNewFileMode():
+    mask = umask(0)
+    umask(mask)
+    return 0o666 & ~mask
+
+
+def writeObjectFile(lgit_path, file_hash, file_path, mode):
+    '''
+    output: stat of the file written with the content of the object, aside
+            then renamed over the old one
+    '''
+    dir_path = path.dirname(file_path)
+    makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = mkstemp(prefix='.lgit_tmp_', dir=dir_path)
+    try:
+        with fdopen(fd, 'wb') as f:
+            for data in readObjectChunks(lgit_path, file_hash):
+                f.write(data)
+            fchmod(f.fileno(), mode)
+        rename(tmp_path, file_path)
+    except BaseException:
+        unlink(tmp_path)
+        raise
+    return stat(file_path)
+
+
+# Get the SHA1 of a file of the working tree, from the index if its stat
+# data did not change, None if it is missing
+def getWorktreeHash(entry, file_path, index):
+    try:
+        file_stat = stat(file_path)
+    except FileNotFoundError:
+        return None
+    if entry is not None and index.isUpToDate(entry, file_stat):
+        return entry.current_hash
+    return getSha1(file_path)
+
+
+def checkoutFiles(repo, files, jobs=1, staged=False, committed=False):
+    '''
+    input: files: {path: SHA1} to write in the working tree; staged,
+           committed: also set the added and committed SHA1 of the entries
+    output: number of files written, the ones whose entry and stat data
+            show they are already right are skipped; their entries get the
+            stat data of the files in the same pass
+    '''
+    index = repo.getIndex(write=True)
+    checked = []
+    to_write = []
+    for file_name, file_hash in sorted(files.items()):
+        entry = index.get(file_name)
+        try:
+            file_stat = stat(path.join(repo.root, file_name))
+        except FileNotFoundError:
+            file_stat = None
+        if (file_stat is not None and entry is not None and
+                entry.current_hash == file_hash and
+                index.isUpToDate(entry, file_stat)):
+            checked.append((file_name, file_hash, file_stat))
+        else:
+            to_write.append((file_name, file_hash))
+    mode = getNewFileMode()
+    with ThreadPoolExecutor(max_workers=max(jobs or 1, 1)) as executor:
+        stats = executor.map(
+            lambda item: writeObjectFile(repo.lgit_path, item[1],
+                                         path.join(repo.root, item[0]),
+                                         mode), to_write)
+        for (file_name, file_hash), file_stat in zip(to_write, stats):
+            checked.append((file_name, file_hash, file_stat))
+    for file_name, file_hash, file_stat in checked:
+        entry = index.get(file_name)
+        add_hash = file_hash if staged or entry is None else entry.add_hash
+        if committed:
+            commit_hash = file_hash
+        else:
+            commit_hash = entry.commit_hash if entry is not None else None
+        entry = IndexEntry(None, file_hash, add_hash, commit_hash, file_name)
+        index.refreshStat(entry, file_stat)
+    return len(to_write)
+
+
+# Remove a file of the working tree and the dirs it leaves empty
+def removeWorktreeFile(root, file_name):
+    try:
+        unlink(path.join(root, file_name))
+    except FileNotFoundError:
+        pass
+    dir_name = path.dirname(file_name)
+    while dir_name:
+        try:
+            rmdir(path.join(root, dir_name))
+        except OSError:
+            break
+        dir_name = path.dirname(dir_name)
+
+
+def getCheckoutConflicts(repo, files):
+    '''
+    input: files: {path: SHA1} of the commit to switch to
+    output: paths whose local changes would be lost by the switch
+    '''
+    index = repo.getIndex(write=True)
+    conflicts = []
+    for entry in index:
+        target_hash = files.get(entry.path)
+        if target_hash == entry.commit_hash:
+            continue
+        worktree_hash = getWorktreeHash(entry, path.join(repo.root,
+                                                         entry.path), index)
+        if entry.isStaged() or worktree_hash not in (None, entry.add_hash):
+            conflicts.append(entry.path)
+    for file_name, file_hash in files.items():
+        if file_name in index:
+            continue
+        # an untracked file in the way
+        worktree_hash = getWorktreeHash(None, path.join(repo.root, file_name),
+                                        index)
+        if worktree_hash not in (None, file_hash):
+            conflicts.append(file_name)
+    return sorted(conflicts)
+
+
+def switchCommit(repo, commit_hash, force=False, jobs=1):
+    files = getCommitFiles(repo.lgit_path, commit_hash)
+    if not force:
+        conflicts = getCheckoutConflicts(repo, files)
+        if conflicts:
+            print('error: Your local changes to the following files would be'
+                  ' overwritten by checkout:')
+            for file_name in conflicts:
+                print('\t' + file_name)
+            print('Please commit your changes before you switch.')
+            print('Aborting')
+            return
+    index = repo.getIndex(write=True)
+    # files of the old commit that are not in the new one
+    for entry in index.getEntries():
+        if entry.commit_hash is not None and entry.path not in files:
+            index.remove(entry.path)
+            removeWorktreeFile(repo.root, entry.path)
+    if not force:
+        # files that are the same in both commits keep their local changes
+        for entry in index.getEntries():
+            if (entry.commit_hash is not None and
+                    files.get(entry.path) == entry.commit_hash):
+                del files[entry.path]
+    checkoutFiles(repo, files, jobs, staged=True, committed=True)
+    writeHead(repo.lgit_path, commit_hash)
+    commit = readCommit(repo.lgit_path, commit_hash)
+    print('HEAD is now at {} {}'.format(commit_hash[:7],
+                                        commit['message'].split('\n')[0]))
+
+
+# Get the files of {path: SHA1} that are the paths or under them
+def getFilesInPaths(files, paths, root):
+    names = getPathspecs(paths, root)
+    if names is None:
+        return None
+    matched = {}
+    for name, file_path in zip(names, paths):
+        found = False
+        for file_name, file_hash in files.items():
+            if not name or file_name == name or \
+                    file_name.startswith(name + '/'):
+                matched[file_name] = file_hash
+                found = True
+        if not found:
+            print("error: pathspec '{}' did not match any file(s) known to"
+                  " lgit".format(file_path))
+            return None
+    return matched
+
+
+def checkoutGit(repo, targets, force=False, jobs=1):
+    '''
+    A first target naming a commit, and not a file, is the commit to switch
+    to, or to restore the paths after it from. Without one the paths are
+    restored from the index.
+    '''
+    commit_hash = None
+    if targets and not path.exists(targets[0]):
+        commit_hash = resolveCommit(repo.lgit_path, targets[0])
+        if commit_hash is not None:
+            targets = targets[1:]
+    if commit_hash is not None and not targets:
+        switchCommit(repo, commit_hash, force, jobs)
+        return
+    if not targets:
+        print('fatal: you must specify a commit or paths to checkout')
+        return
+    index = repo.getIndex(write=True)
+    if commit_hash is None:
+        files = {entry.path: entry.add_hash for entry in index}
+    else:
+        files = getCommitFiles(repo.lgit_path, commit_hash)
+    files = getFilesInPaths(files, targets, repo.root)
+    if files is None:
+        return
+    count = checkoutFiles(repo, files, jobs, staged=commit_hash is not None)
+    print('Updated {} path{} from {}'.format(
+        count, '' if count == 1 else 's',
+        'the index' if commit_hash is None else commit_hash[:7]))
+
+
+'''_____________________GIT DIFF_________________________________'''
+
+
+DIFF_CONTEXT = 3
+# A file with a NUL byte in its start is shown as binary
+BINARY_CHECK_SIZE = 8000
+# Past this many edits, or the square root of the lines if more, the
+# search for the shortest edit script stops at its furthest point and
+# goes on from there, like xdiff, so a rewrite does not take minutes
+DIFF_MIN_COST = 64
+# Steps of the search allowed per line of the files, the ranges left when
+# they are used up are shown as changed
+DIFF_MAX_WORK = 50
+# A line found more often than the square root of the lines on the other
+# side, within these bounds, is too common to anchor the search on
+DIFF_MIN_EQUAL = 16
+DIFF_MAX_EQUAL = 1024
+
+
+def isBinary(data):
+    return b'\0' in data[:BINARY_CHECK_SIZE]
+
+
+def findMiddleSnake(a, a_lo, a_hi, b, b_lo, b_hi, max_cost):
+    '''
+    Myers' linear space search: the shortest edit script is searched from
+    both ends at once until the paths overlap, or for max_cost edits
+    output: (x0, y0, x1, y1) of the middle snake, relative to a_lo, b_lo,
+            or the furthest point reached from the start if it costs more;
+            and the number of edits searched
+    '''
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    # the search stops after max_cost edits, the diagonals are only kept
+    # for as many
+    max_d = min((n + m + 1) // 2, max_cost + 1)
+    offset = max_d + 1
+    # furthest x on each diagonal k = x - y, from the start and the end
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    best = (0, 0)
+    for d in range(max_d + 1):
+        if d > max_cost and 0 < best[0] + best[1] < n + m:
+            return best + best + (d,)
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           forward[k - 1 + offset] < forward[k + 1 + offset]):
+                x = forward[k + 1 + offset]
+            else:
+                x = forward[k - 1 + offset] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k + offset] = x
+            if x <= n and 0 <= y <= m and x + y > best[0] + best[1]:
+                best = (x, y)
+            if odd and -(d - 1) <= delta - k <= d - 1 and \
+                    x + backward[delta - k + offset] >= n:
+                return x0, y0, x, y, d
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1 + offset] <
+                           backward[k + 1 + offset]):
+                x = backward[k + 1 + offset]
+            else:
+                x = backward[k - 1 + offset] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and \
+                    a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k + offset] = x
+            if not odd and -d <= delta - k <= d and \
+                    x + forward[delta - k + offset] >= n:
+                return n - x, m - y, n - x0, m - y0, d
+    return 0, 0, 0, 0, max_d
+
+
+def getMatchingBlocks(a, b):
+    '''
+    output: list of (i, j, size) where a[i:i + size] == b[j:j + size],
+            in order, ending with (len(a), len(b), 0)
+    '''
+    # lines are compared as numbers
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    a_lines = getDiffLines(a_ids, b_ids)
+    b_lines = getDiffLines(b_ids, a_ids)
+    merged = []
+    for i, j, size in getCommonBlocks([a_ids[i] for i in a_lines],
+                                      [b_ids[j] for j in b_lines]):
+        for pos in range(size):
+            i_pos, j_pos = a_lines[i + pos], b_lines[j + pos]
+            last = merged[-1] if merged else None
+            if last and last[0] + last[2] == i_pos and \
+                    last[1] + last[2] == j_pos:
+                merged[-1] = (last[0], last[1], last[2] + 1)
+            else:
+                merged.append((i_pos, j_pos, 1))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+
+def getDiffLines(ids, other_ids):
+    '''
+    output: positions of the lines of ids worth searching, like xdiff: a
+            line the other side does not have can not match, a line it has
+            many times is only kept next to a line that is kept
+    '''
+    counts = {}
+    for line_id in other_ids:
+        counts[line_id] = counts.get(line_id, 0) + 1
+    max_count = min(DIFF_MAX_EQUAL, max(isqrt(len(ids) + len(other_ids)),
+                                        DIFF_MIN_EQUAL))
+    # 0: left out, 1: kept, 2: kept if next to a kept line
+    actions = []
+    for line_id in ids:
+        count = counts.get(line_id, 0)
+        actions.append(0 if not count else 2 if count > max_count else 1)
+    return [pos for pos, action in enumerate(actions) if action == 1 or
+            (action == 2 and ((pos and actions[pos - 1] == 1) or
+                              (pos + 1 < len(actions) and
+                               actions[pos + 1] == 1)))]
+
+
+def getCommonBlocks(a, b):
+    '''
+    output: list of (i, j, size) where a[i:i + size] == b[j:j + size], in
+            order, found by splitting the ranges at their middle snakes
+    '''
+    max_cost = max(DIFF_MIN_COST, isqrt(len(a) + len(b)))
+    work = DIFF_MAX_WORK * (len(a) + len(b))
+    blocks = []
+    # ranges to diff and blocks found, in the order they are output
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        task = stack.pop()
+        if len(task) == 3:
+            blocks.append(task)
+            continue
+        a_lo, a_hi, b_lo, b_hi = task
+        prefix = 0
+        while (a_lo + prefix < a_hi and b_lo + prefix < b_hi and
+               a[a_lo + prefix] == b[b_lo + prefix]):
+            prefix += 1
+        if prefix:
+            blocks.append((a_lo, b_lo, prefix))
+            a_lo += prefix
+            b_lo += prefix
+        suffix = 0
+        while (a_lo < a_hi - suffix and b_lo < b_hi - suffix and
+               a[a_hi - 1 - suffix] == b[b_hi - 1 - suffix]):
+            suffix += 1
+        if suffix:
+            stack.append((a_hi - suffix, b_hi - suffix, suffix))
+            a_hi -= suffix
+            b_hi -= suffix
+        if a_lo == a_hi or b_lo == b_hi or work <= 0:
+            continue
+        x0, y0, x1, y1, cost = findMiddleSnake(a, a_lo, a_hi, b, b_lo, b_hi,
+                                               max_cost)
+        # each edit searched costs that many steps in both directions
+        work -= (cost + 1) * (cost + 1)
+        if (x0, y0) == (0, 0) and (x1, y1) in ((0, 0), (a_hi - a_lo,
+                                                         b_hi - b_lo)):
+            # no split, the range is all changed
+            continue
+        stack.append((a_lo + x1, a_hi, b_lo + y1, b_hi))
+        if x1 > x0:
+            stack.append((a_lo + x0, b_lo + y0, x1 - x0))
+        stack.append((a_lo, a_lo + x0, b_lo, b_lo + y0))
+    return blocks
+
+
+def iterHunks(a, b, context=DIFF_CONTEXT):
+    '''
+    output: generator of hunks (a_start, a_count, b_start, b_count, lines),
+            lines are (' ', '-' or '+', line), changes closer than two
+            contexts are in the same hunk
+    '''
+    changes = []
+    i = j = 0
+    for block_i, block_j, size in getMatchingBlocks(a, b):
+        if i < block_i or j < block_j:
+            changes.append((i, block_i, j, block_j))
+        i, j = block_i + size, block_j + size
+    pos = 0
+    while pos < len(changes):
+        end = pos
+        while (end + 1 < len(changes) and
+               changes[end + 1][0] - changes[end][1] <= 2 * context):
+            end += 1
+        a_start = max(changes[pos][0] - context, 0)
+        a_end = min(changes[end][1] + context, len(a))
+        b_start = changes[pos][2] - (changes[pos][0] - a_start)
+        b_end = changes[end][3] + (a_end - changes[end][1])
+        lines = []
+        i = a_start
+        for a_lo, a_hi, b_lo, b_hi in changes[pos:end + 1]:
+            lines.extend((' ', line) for line in a[i:a_lo])
+            lines.extend(('-', line) for line in a[a_lo:a_hi])
+            lines.extend(('+', line) for line in b[b_lo:b_hi])
+            i = a_hi
+        lines.extend((' ', line) for line in a[i:a_end])
+        yield a_start, a_end - a_start, b_start, b_end - b_start, lines
+        pos = end + 1
+
+
+# Format the start and count of a hunk range, like diff -u
+def formatHunkRange(start, count):
+    if count == 1:
+        return str(start + 1)
+    if count == 0:
+        return '{},0'.format(start)
+    return '{},{}'.format(start + 1, count)
+
+
+def printFileDiff(file_name, old_hash, new_hash, old_data, new_data):
+    print('diff --lgit a/{0} b/{0}'.format(file_name))
+    if old_hash is None:
+        print('new file')
+    elif new_hash is None:
+        print('deleted file')
+    print('index {}..{}'.format((old_hash or '0' * 40)[:7],
+                                (new_hash or '0' * 40)[:7]))
+    old_name = 'a/' + file_name if old_hash is not None else '/dev/null'
+    new_name = 'b/' + file_name if new_hash is not None else '/dev/null'
+    # the data of a binary file is not read, it is None
+    if old_data is None or new_data is None:
+        print('Binary files {} and {} differ'.format(old_name, new_name))
+        return
+    print('--- ' + old_name)
+    print('+++ ' + new_name)
+    a = old_data.splitlines(keepends=True)
+    b = new_data.splitlines(keepends=True)
+    for a_start, a_count, b_start, b_count, lines in iterHunks(a, b):
+        print('@@ -{} +{} @@'.format(formatHunkRange(a_start, a_count),
+                                     formatHunkRange(b_start, b_count)))
+        for tag, line in lines:
+            text = line.decode(errors='surrogateescape')
+            sys.stdout.write(tag + text)
+            if not text.endswith('\n'):
+                sys.stdout.write('\n\\ No newline at end of file\n')
+
+
+def getWorktreeFiles(repo):
+    '''
+    output: {path: SHA1} of the tracked files in the working tree, a file is
+            only hashed again if its stat data changed
+    '''
+    index = repo.getIndex()
+    files = {}
+    for entry in index.getEntries():
+        file_path = path.join(repo.root, entry.path)
+        updateWithStatus(entry, file_path, index)
+        if path.isfile(file_path):
+            files[entry.path] = entry.current_hash
+    return files
+
+
+def diffFiles(repo, old_files, new_files, worktree=False):
+    '''
+    input: old_files, new_files: {path: SHA1}; worktree: the new files are
+           read from the working tree instead of objects
+    output: print the diff of the files whose SHA1 differ, the others are
+            not read
+    '''
+    # Get the content of a file, None if its start shows it is binary,
+    # then the rest is not read
+    def readData(file_name, file_hash, from_worktree):
+        if file_hash is None:
+            return b''
+        if from_worktree:
+            with open(path.join(repo.root, file_name), 'rb') as f:
+                data = f.read(BINARY_CHECK_SIZE)
+                return None if isBinary(data) else data + f.read()
+        chunks = readObjectChunks(repo.lgit_path, file_hash)
+        data = b''
+        for chunk in chunks:
+            data += chunk
+            if len(data) >= BINARY_CHECK_SIZE:
+                break
+        if isBinary(data):
+            chunks.close()
+            return None
+        return data + b''.join(chunks)
+    for file_name in sorted(set(old_files) | set(new_files)):
+        old_hash = old_files.get(file_name)
+        new_hash = new_files.get(file_name)
+        if old_hash == new_hash:
+            continue
+        old_data = readData(file_name, old_hash, False)
+        new_data = None
+        if old_data is not None:
+            new_data = readData(file_name, new_hash, worktree)
+        printFileDiff(file_name, old_hash, new_hash, old_data, new_data)
+
+
+def diffGit(repo, targets, cached=False):
+    '''
+    Without commits the working tree is compared with the index, with
+    cached the index with the last commit. One commit is compared with the
+    working tree, or the index if cached; two commits with each other.
+    '''
+    revs = []
+    while targets and len(revs) < 2 and not path.exists(targets[0]):
+        commit_hash = resolveCommit(repo.lgit_path, targets[0])
+        if commit_hash is None:
+            break
+        revs.append(commit_hash)
+        targets = targets[1:]
+    index = repo.getIndex()
+    worktree = False
+    if len(revs) == 2:
+        old_files = getCommitFiles(repo.lgit_path, revs[0])
+        new_files = getCommitFiles(repo.lgit_path, revs[1])
+    elif cached:
+        new_files = {entry.path: entry.add_hash for entry in index}
+        if revs:
+            old_files = getCommitFiles(repo.lgit_path, revs[0])
+        else:
+            old_files = {entry.path: entry.commit_hash for entry in index
+                         if entry.commit_hash is not None}
+    else:
+        worktree = True
+        new_files = getWorktreeFiles(repo)
+        if revs:
+            old_files = getCommitFiles(repo.lgit_path, revs[0])
+        else:
+            old_files = {entry.path: entry.add_hash for entry in index}
+    if targets:
+        names = getPathspecs(targets, repo.root)
+        if names is None:
+            return
+
+        def isInTargets(file_name):
+            return any(not name or file_name == name or
+                       file_name.startswith(name + '/') for name in names)
+        old_files = {file_name: file_hash for file_name, file_hash
+                     in old_files.items() if isInTargets(file_name)}
+        new_files = {file_name: file_hash for file_name, file_hash
+                     in new_files.items() if isInTargets(file_name)}
+    diffFiles(repo, old_files, new_files, worktree)
+
+
+'''_____________________GIT PATHSPEC_________________________________'''
+
+
+# A pathspec is a path relative to the root of the working tree: a file,
+# a dir for all the files under it, '' for all files, or a glob where '*'
+# also matches '/'.
+
+
+def getPathspecs(paths, root):
+    '''
+    input: paths: paths given on the command line
+    output: their pathspecs, None if one is outside the repository
+    '''
+    specs = []
+    for file_path in paths:
+        spec = getIndexFileName(path.abspath(file_path), root)
+        if spec == '..' or spec.startswith('../'):
+            print("fatal: '{}' is outside repository".format(file_path))
+            return None
+        specs.append(spec)
+    return specs
+
+
+def isPathspecGlob(spec):
+    return any(char in spec for char in '*?[')
+
+
+# Get the part of a pathspec before its first glob character
+def getPathspecPrefix(spec):
+    match = re.search(r'[*?\[]', spec)
+    return spec if match is None else spec[:match.start()]
+
+
+def matchPathspec(index, spec):
+    '''
+    output: entries of the index matched by the pathspec, sorted by path,
+            only the entries starting like it are looked at
+    '''
+    if isPathspecGlob(spec):
+        return [entry for entry in index.getEntriesUnder(
+                    getPathspecPrefix(spec))
+                if fnmatchcase(entry.path, spec)]
+    entry = index.get(spec)
+    if entry is not None:
+        return [entry]
+    return index.getEntriesUnder(spec + '/' if spec else '')
+
+
+'''_____________________GIT LS-FILES_________________________________'''
+
+
+def lsFileGit(repo, pathspecs=()):
+    '''
+    List the files of the index under the current dir, or matched by the
+    pathspecs, found in the index without walking the working tree
+    '''
+    cur_dir = getcwd()
+    index = repo.getIndex()
+    cur_spec = getIndexFileName(cur_dir, repo.root)
+    specs = getPathspecs(pathspecs, repo.root)
+    if specs is None:
+        return
+    specs = specs or [cur_spec]
+    file_names = set()
+    for spec in specs:
+        file_names.update(entry.path for entry in matchPathspec(index, spec))
+    # names are shown relative to the current directory
+    prefix = cur_spec + '/' if cur_spec else ''
+    for file_name in sorted(file_names, key=fsencode):
+        if file_name.startswith(prefix):
+            print(file_name[len(prefix):])
+        else:
+            print(path.relpath(path.join(repo.root, file_name)))
+
+
+'''__________________GIT LOG_________________________________'''
+
+
+# Get the sorted list of files in commits dir
+def getCommitsFiles(lgit_path):
+    commits_path = path.join(lgit_path, 'commits')
+    paths = []
+    for root, _, files in walk(commits_path):
+        for file in files:
+            file_path = path.join(root, file)
+            paths.append(file_path)
+    return sorted((paths), key=lambda x: float(x.split('/')[-1]), reverse=True)
+
+
+# The commit-graph caches the history for log: a header, then a record per
+# commit in the order they were made: (timestamp of the commit, SHA1 of its
+# commit object or zeros for an old commit that has only a commits/ file,
+# position of its parent record or -1)
+COMMIT_GRAPH_MAGIC = b'LCGR'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HEADER = Struct('>4sI')
+COMMIT_GRAPH_RECORD = Struct('>21s20si')
+NO_COMMIT_HASH = bytes(20)
+
+
+def readGraphRecord(f, pos):
+    '''
+    output: (timestamp, SHA1 or None, parent position) of a record
+    '''
+    f.seek(COMMIT_GRAPH_HEADER.size + pos * COMMIT_GRAPH_RECORD.size)
+    timestamp, commit_hash, parent_pos = COMMIT_GRAPH_RECORD.unpack(
+        f.read(COMMIT_GRAPH_RECORD.size))
+    commit_hash = None if commit_hash == NO_COMMIT_HASH else commit_hash.hex()
+    return timestamp.decode(), commit_hash, parent_pos
+
+
+def getGraphCount(f):
+    f.seek(0, 2)
+    return (f.tell() - COMMIT_GRAPH_HEADER.size) // COMMIT_GRAPH_RECORD.size
+
+
+def findGraphPos(f, count, commit_hash):
+    # new commits are at the end, so look from the end
+    for pos in range(count - 1, -1, -1):
+        if readGraphRecord(f, pos)[1] == commit_hash:
+            return pos
+    return None
+
+
+# Open the commit-graph for reading, None if missing or not valid
+def openCommitGraph(lgit_path, mode='rb'):
+    try:
+        f = open(path.join(lgit_path, 'commit-graph'), mode)
+    except FileNotFoundError:
+        return None
+    header = f.read(COMMIT_GRAPH_HEADER.size)
+    if header != COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_MAGIC,
+                                          COMMIT_GRAPH_VERSION):
+        f.close()
+        return None
+    return f
+
+
+def rebuildCommitGraph(lgit_path, lock=None):
+    '''
+    input: lock: LockFile of the commit-graph held by the caller, else it
+           is taken here
+    output: write the commit-graph from the old commits/ files and the
+            commit objects reachable from HEAD
+    '''
+    if lock is None:
+        with LockFile(path.join(lgit_path, 'commit-graph')).acquire() as lock:
+            rebuildCommitGraph(lgit_path, lock)
+        return
+    chain = []
+    commit_hash = readHead(lgit_path)
+    while commit_hash is not None:
+        commit = readCommit(lgit_path, commit_hash)
+        chain.append((commit['date'], commit_hash))
+        commit_hash = commit['parent']
+    chain.reverse()
+    dates = set(date for date, _ in chain)
+    # commits made before commit objects existed come first
+    legacy = [(path.basename(file_path), None)
+              for file_path in reversed(getCommitsFiles(lgit_path))
+              if path.basename(file_path) not in dates]
+    records = [COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_MAGIC,
+                                        COMMIT_GRAPH_VERSION)]
+    for pos, (date, commit_hash) in enumerate(legacy + chain):
+        raw_hash = bytes.fromhex(commit_hash) if commit_hash else \
+            NO_COMMIT_HASH
+        records.append(COMMIT_GRAPH_RECORD.pack(date.encode(), raw_hash,
+                                                pos - 1))
+    lock.write(b''.join(records))
+    lock.commit()
+
+
+def appendCommitGraph(lgit_path, date, commit_hash, parent_hash):
+    '''
+    output: add the record of a new commit to the end of the commit-graph,
+            which is rebuilt if it is missing or does not have the parent
+    '''
+    # the lock keeps a rebuild by log from replacing the file meanwhile
+    with LockFile(path.join(lgit_path, 'commit-graph')).acquire() as lock:
+        f = openCommitGraph(lgit_path, 'r+b')
+        if f is not None:
+            with f:
+                count = getGraphCount(f)
+                if parent_hash is None:
+                    # the first commit object follows the old commits
+                    parent_pos = count - 1
+                else:
+                    parent_pos = findGraphPos(f, count, parent_hash)
+                if parent_pos is not None:
+                    f.seek(COMMIT_GRAPH_HEADER.size +
+                           count * COMMIT_GRAPH_RECORD.size)
+                    f.write(COMMIT_GRAPH_RECORD.pack(
+                        date.encode(), bytes.fromhex(commit_hash),
+                        parent_pos))
+                    return
+        rebuildCommitGraph(lgit_path, lock)
+
+
+def iterCommitGraph(lgit_path):
+    '''
+    output: generator of (timestamp, SHA1 or None) of the commits from HEAD
+            back to the first one, reading one record at a time
+    '''
+    head = readHead(lgit_path)
+    for attempt in range(2):
+        f = openCommitGraph(lgit_path)
+        if f is not None:
+            count = getGraphCount(f)
+            if head is None:
+                pos = count - 1
+            else:
+                pos = findGraphPos(f, count, head)
+            if pos is not None:
+                break
+            f.close()
+        # missing or stale: made again once from the commits
+        rebuildCommitGraph(lgit_path)
+    else:
+        return
+    with f:
+        while pos >= 0:
+            timestamp, commit_hash, pos = readGraphRecord(f, pos)
+            yield timestamp, commit_hash
+
+
+# Get a 'YYYYmmddHHMMSS' prefix from a date given to --since
+def parseSince(since):
+    return ''.join(char for char in since if char.isdigit())
+
+
+def iterLog(lgit_path, since=None):
+    '''
+    output: generator of dicts of the commits to show, newest first, each
+            commit is read only when it is reached
+    '''
+    since = parseSince(since) if since else None
+    for timestamp, commit_hash in iterCommitGraph(lgit_path):
+        if since is not None and timestamp[:len(since)] < since:
+            break
+        if commit_hash is not None:
+            commit = readCommit(lgit_path, commit_hash)
+            commit['id'] = commit_hash
+        else:
+            content = getFileContent(path.join(lgit_path, 'commits',
+                                               timestamp))
+            if content is None:
+                continue
+            commit = {'id': timestamp, 'author': content[0].strip('\n'),
+                      'message': ''.join(content[3:]).rstrip('\n')}
+        commit['date'] = timestamp
+        yield commit
+
+
+def getReadableTime(timestamp):
+    return datetime.strptime(timestamp, '%Y%m%d%H%M%S.%f').strftime(
+        '%a %b %d %H:%M:%S %Y')
+
+
+def logGit(repo, max_count=None, since=None, oneline=False):
+    commits = iterLog(repo.lgit_path, since)
+    if max_count is not None:
+        commits = islice(commits, max(max_count, 0))
+    is_empty = True
+    for commit in commits:
+        is_empty = False
+        if oneline:
+            print(commit['id'][:7], commit['message'].split('\n')[0])
+            continue
+        print('commit', commit['id'])
+        print('Author:', commit['author'])
+        print('Date: {}\n'.format(getReadableTime(commit['date'])))
+        message = commit['message'].replace('\n', '\n\t')
+        print('\t{}\n'.format(message))
+    if is_empty and max_count is None and since is None:
+        print("fatal: your current branch 'master' does" +
+              " not have any commits yet")
+
+
+'''_____________________GIT RM_________________________________'''
+
+
+def rmGit(repo, pathspecs, recursive=False, cached=False):
+    '''
+    input: pathspecs: files, dirs with recursive, or globs; cached: keep
+           the files in the working tree
+    output: remove the matched entries from the index, all of them or none
+            if a pathspec is wrong, the index is written once at the end
+    '''
+    specs = getPathspecs(pathspecs, repo.root)
+    if specs is None:
+        return
+    index = repo.getIndex(write=True)
+    entries = []
+    for pathspec, spec in zip(pathspecs, specs):
+        matched = matchPathspec(index, spec)
+        if not matched:
+            print("fatal: pathspec '{}' did not match any files".format(
+                pathspec))
+            return
+        if not recursive and not isPathspecGlob(spec) and \
+                matched[0].path != spec:
+            print("fatal: not removing '{}' recursively without -r".format(
+                pathspec))
+            return
+        entries.extend(matched)
+    removed = set()
+    for entry in entries:
+        if entry.path in removed:
+            continue
+        removed.add(entry.path)
+        index.remove(entry.path)
+        if not cached:
+            removeWorktreeFile(repo.root, entry.path)
+        print("rm '{}'".format(entry.path))
+
+
+'''_____________________GIT CONFIG_________________________________'''
+
+
+# Read the config: the author name on the first line, then 'key = value'
+def readConfig(lgit_path):
+    config = {'author': ''}
+    config_content = getFileContent(path.join(lgit_path, 'config')) or []
+    for idx, line in enumerate(config_content):
+        line = line.strip('\n')
+        if idx == 0 and '=' not in line:
+            config['author'] = line
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            config[key.strip()] = value.strip()
+    return config
+
+
+def formatConfig(config):
+    content = [config['author']]
+    for key, value in config.items():
+        if key != 'author':
+            content.append('{} = {}'.format(key, value))
+    return '\n'.join(content) + '\n'
+
+
+def configGit(repo, author, compression=None, untracked_cache=None,
+              fsync=None, chunk_threshold=None):
+    changes = {}
+    if chunk_threshold is not None:
+        try:
+            parseSize(chunk_threshold)
+        except ValueError:
+            print("fatal: invalid size '{}'".format(chunk_threshold))
+            return
+        changes['chunk_threshold'] = chunk_threshold
+    if author is not None:
+        changes['author'] = author
+    if compression is not None:
+        changes['compression'] = str(compression)
+    if untracked_cache is not None:
+        changes['untracked_cache'] = untracked_cache
+    if fsync is not None:
+        changes['fsync'] = fsync
+    repo.updateConfig(changes)
+
+
+'''_____________________GIT BATCH_________________________________'''
+
+
+BATCH_COMMANDS = ('add', 'rm', 'commit', 'status', 'ls-files', 'log')
+
+
+def runBatchLine(line, repo, run_command):
+    '''
+    input: line: one command, as it would be given to lgit.py
+    output: dict of the result, with the output the command printed
+    '''
+    result = {'command': line, 'ok': True}
+    out = StringIO()
+    err = StringIO()
+    try:
+        with redirect_stdout(out), redirect_stderr(err):
+            argv = shlex.split(line)
+            if argv == ['checkpoint']:
+                repo.flush()
+            elif not argv or argv[0] not in BATCH_COMMANDS:
+                print('fatal: not a batch command:', line, file=sys.stderr)
+                result['ok'] = False
+            else:
+                run_command(getArgs(argv), repo)
+    except SystemExit as e:
+        # argparse exits on a bad command line or on --help
+        result['ok'] = not e.code
+    except Exception as e:
+        result['ok'] = False
+        err.write('fatal: {}\n'.format(e))
+    result['output'] = out.getvalue()
+    result['error'] = err.getvalue()
+    return result
+
+
+def runBatch(lines, reply, repo, run_command):
+    '''
+    Run the commands one per line against the same repository, the index
+    is written once at the end of the input or on a checkpoint command
+    '''
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            reply(json.dumps(runBatchLine(line, repo, run_command)) + '\n')
+    finally:
+        repo.flush()
+
+
+def batchGit(repo, run_command, socket_path=None):
+    if socket_path is None:
+        def reply(response):
+            sys.stdout.write(response)
+            sys.stdout.flush()
+        runBatch(sys.stdin, reply, repo, run_command)
+        return
+    try:
+        unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    server = socket(AF_UNIX, SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    try:
+        # clients are served one at a time, each one is a batch
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile('r') as lines, \
+                    conn.makefile('w') as replies:
+                def reply(response):
+                    replies.write(response)
+                    replies.flush()
+                # other processes may have changed the repository since
+                # the last client
+                repo.reload()
+                try:
+                    runBatch(lines, reply, repo, run_command)
+                except OSError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        unlink(socket_path)
+
+
+'''_____________________PERF TRACE_________________________________'''
+
+
+# Get the size of a file, 0 if it is gone
+def getFileSize(file):
+    try:
+        return stat(file).st_size
+    except OSError:
+        return 0
+
+
+# Functions timed by the trace, with how to count the bytes they handle
+TRACED_FUNCTIONS = {
+    'getDirRecursively': None,
+    'getSha1': lambda args, result: getFileSize(args[0]),
+    'getFileContent': lambda args, result: sum(map(len, result or ())),
+    'writeFileContent': lambda args, result: len(args[1]),
+    'updateObjectsWithAdd': lambda args, result: getFileSize(args[1]),
+    'storeObjectData': lambda args, result: len(args[1]),
+}
+TRACED_METHODS = {
+    (Index, 'load'): lambda args, result: getFileSize(args[0].index_path),
+    (Index, 'flush'): lambda args, result: getFileSize(args[0].index_path),
+}
+
+
+# Call counts, time and bytes of the traced functions of one process
+class PerfTrace:
+    def __init__(self, output):
+        # 'summary' to print a table, else the path of a Chrome trace
+        self.output = output
+        self.lock = Lock()
+        self.start = perf_counter()
+        # name: [calls, seconds, bytes]
+        self.stats = {}
+        self.events = []
+
+    def record(self, name, start, end, size):
+        with self.lock:
+            stat = self.stats.setdefault(name, [0, 0.0, 0])
+            stat[0] += 1
+            stat[1] += end - start
+            stat[2] += size or 0
+            if self.output != 'summary':
+                event = {'name': name, 'ph': 'X', 'pid': getpid(),
+                         'tid': get_ident(),
+                         'ts': (start - self.start) * 1e6,
+                         'dur': (end - start) * 1e6}
+                if size is not None:
+                    event['args'] = {'bytes': size}
+                self.events.append(event)
+
+    def wrap(self, name, func, count_bytes):
+        def traced(*args, **kwargs):
+            start = perf_counter()
+            result = func(*args, **kwargs)
+            end = perf_counter()
+            size = None if count_bytes is None else count_bytes(args, result)
+            self.record(name, start, end, size)
+            return result
+        traced.__name__ = func.__name__
+        traced.__doc__ = func.__doc__
+        return traced
+
+    def report(self):
+        self.record('total', self.start, perf_counter(), None)
+        if self.output == 'summary':
+            print('{:<24}{:>8}{:>12}{:>12}{:>14}'.format(
+                'function', 'calls', 'total ms', 'mean us', 'bytes'),
+                file=sys.stderr)
+            for name, (calls, seconds, size) in sorted(
+                    self.stats.items(), key=lambda item: -item[1][1]):
+                print('{:<24}{:>8}{:>12.2f}{:>12.1f}{:>14}'.format(
+                    name, calls, seconds * 1e3, seconds * 1e6 / calls, size),
+                    file=sys.stderr)
+        else:
+            with open(self.output, 'w') as f:
+                json.dump({'traceEvents': self.events}, f)
+
+
+def startTrace(output):
+    '''
+    input: output: 'summary' (or '1') to print a table to stderr at exit,
+           else the path of a Chrome trace-event file, None to not trace
+    output: the PerfTrace, the traced functions are replaced in this module
+            so the calls between them are timed too
+    '''
+    if not output or output == '0':
+        return None
+    trace = PerfTrace('summary' if output == '1' else output)
+    module = globals()
+    for name, count_bytes in TRACED_FUNCTIONS.items():
+        module[name] = trace.wrap(name, module[name], count_bytes)
+    for (cls, name), count_bytes in TRACED_METHODS.items():
+        setattr(cls, name, trace.wrap('{}.{}'.format(cls.__name__, name),
+                                      getattr(cls, name), count_bytes))
+    atexit.register(trace.report)
+    return trace